@@ -0,0 +1,299 @@
+"""Benchmarks for buildbot_scheduler_graph.
+
+Run with `python bench_buildbot_scheduler_graph.py [sizes...]`. Each
+benchmark generates a synthetic config with the given number of Schedulers
+and runs every stage of the tool on it, reporting the time each stage took
+and the peak memory it used. Per-Scheduler times should stay roughly flat
+as the size grows if a stage scales linearly.
+
+Results can be saved with --output and compared to a previous run with
+--compare, eg: to check a change for regressions.
+
+--chunks sets how many chunks each chunked builder in the config is split
+into. Whatever it is, merge_nodes is also run on a graph of builders split
+into 40 chunks each (eg: "foo 1/40" ... "foo 40/40"), and the memory that
+graph_info holds on to is compared between plain dicts and CompactGraphs.
+
+--startup also measures how long the module takes to import, according
+to `python -X importtime`, and how long `--help` takes to run, since
+every run of the tool pays for both.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from buildbot_scheduler_graph import __version__, parse_schedulers, \
+    merge_graph_info, merge_nodes, collapse_equivalent_nodes, \
+    compact_graph_info, write_dot, write_json, render_graph, NameTable
+
+
+class Scheduler:
+    def __init__(self, name, builderNames):
+        self.name = name
+        self.builderNames = builderNames
+
+
+class Triggerable(Scheduler):
+    trigger = True
+
+
+class Dependent(Scheduler):
+    def __init__(self, name, builderNames, upstream_name):
+        super().__init__(name, builderNames)
+        self.upstream_name = upstream_name
+
+
+class AggregatingScheduler(Scheduler):
+    def __init__(self, name, builderNames, upstreamBuilders):
+        super().__init__(name, builderNames)
+        self.upstreamBuilders = upstreamBuilders
+
+    def trigger(self):
+        pass
+
+
+def chunked(name, chunks):
+    return ["%s %d/%d" % (name, i, chunks) for i in range(1, chunks + 1)]
+
+
+def make_config(size, chunks=4):
+    """Generates a config with `size` Schedulers, returning a tuple of the
+       Schedulers, triggerables and sendchanges. The Schedulers come in
+       families of ten, each of which has:
+        * A root Scheduler for chunked build builders (eg: "foo 1/4").
+        * A chain of three Dependent Schedulers hanging off of it.
+        * An AggregatingScheduler that fans in the builders of that chain.
+        * A Triggerable, triggered by the AggregatingScheduler's builder.
+        * A Scheduler that the Triggerable's builder does a sendchange to.
+        * Three more roots with chunked builders.
+    """
+    schedulers = []
+    triggerables = {}
+    sendchanges = {}
+    for family in range(0, size, 10):
+        prefix = "family-%d" % family
+        family_schedulers = [Scheduler("%s build" % prefix, chunked("%s build" % prefix, chunks))]
+        for i in range(1, 4):
+            family_schedulers.append(Dependent(
+                "%s dep-%d" % (prefix, i), chunked("%s test-%d" % (prefix, i), chunks),
+                upstream_name=family_schedulers[-1].name,
+            ))
+        fan_in = []
+        for s in family_schedulers[1:]:
+            fan_in.extend(s.builderNames)
+        family_schedulers.append(AggregatingScheduler("%s agg" % prefix, ["%s agg" % prefix], fan_in))
+        family_schedulers.append(Triggerable("%s trig" % prefix, ["%s trig" % prefix]))
+        triggerables["%s trig" % prefix] = ["%s agg" % prefix]
+        family_schedulers.append(Scheduler("%s sendchange" % prefix, ["%s sendchange" % prefix]))
+        sendchanges["%s sendchange" % prefix] = ["%s trig" % prefix]
+        for i in range(3):
+            family_schedulers.append(Scheduler(
+                "%s nightly-%d" % (prefix, i), chunked("%s nightly-%d" % (prefix, i), chunks),
+            ))
+        schedulers.extend(family_schedulers[:size - family])
+    return schedulers, triggerables, sendchanges
+
+
+def make_chunked_graph(groups, chunks=40):
+    """Generates the nodes and edges of a graph with `groups` chunked
+       builders (eg: "foo 1/40" ... "foo 40/40"), all notified by a single
+       Scheduler."""
+    nodes = set(["sched"])
+    edges = set()
+    for i in range(groups):
+        for j in range(1, chunks + 1):
+            builder = "builder-%d %d/%d" % (i, j, chunks)
+            nodes.add(builder)
+            edges.add(("sched", builder))
+    return nodes, edges
+
+
+def run_stage(func, *args):
+    """Runs func twice: once to time it, and once to measure its peak memory
+       use, since tracing memory slows it down. Returns its result, the time
+       it took and the peak memory it used."""
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def measure_memory(func, *args):
+    """Returns the result of func and the amount of memory it holds on to."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def intern_names(table, graph_info):
+    for info in graph_info.values():
+        for n in info["nodes"]:
+            table.intern(n)
+
+
+def compact_memory(size, schedulers, triggerables, sendchanges):
+    """Returns a result for the memory that graph_info holds on to as plain
+       dicts, and as CompactGraphs plus the NameTable they share."""
+    graph_info, dict_size = measure_memory(parse_schedulers, schedulers, triggerables, sendchanges)
+    table = NameTable()
+    _, table_size = measure_memory(intern_names, table, graph_info)
+    _, compact_size = measure_memory(compact_graph_info, graph_info, table)
+    return {"size": size, "stage": "retained_graph_info", "dict_memory": dict_size,
+            "compact_memory": compact_size, "name_table_memory": table_size}
+
+
+def merge_all_nodes(root_graphs):
+    for info in root_graphs.values():
+        merge_nodes(info["nodes"], info["edges"])
+
+
+def collapse_all_nodes(root_graphs):
+    for info in root_graphs.values():
+        collapse_equivalent_nodes(info["nodes"], info["edges"])
+
+
+def write_all_dot(root_graphs):
+    with open(os.devnull, "w") as f:
+        for info in root_graphs.values():
+            write_dot(f, info["nodes"], info["edges"])
+
+
+def write_all_json(root_graphs):
+    with open(os.devnull, "w") as f:
+        for name, info in root_graphs.items():
+            write_json(f, name, info["nodes"], info["edges"])
+
+
+def render_all(root_graphs, output_dir, formats):
+    for name, info in root_graphs.items():
+        render_graph(name, info["nodes"], info["edges"], output_dir, formats)
+
+
+def bench(size, graphviz_dir=None, chunks=4):
+    schedulers, triggerables, sendchanges = make_config(size, chunks)
+    results = []
+
+    def stage(name, func, *args):
+        result, elapsed, peak = run_stage(func, *args)
+        results.append({"size": size, "stage": name, "seconds": elapsed, "peak_memory": peak})
+        return result
+
+    graph_info = stage("parse_schedulers", parse_schedulers, schedulers, triggerables, sendchanges)
+    stage("compact_graph_info", compact_graph_info, graph_info)
+    root_graphs = stage("merge_graph_info", merge_graph_info, graph_info)
+    stage("merge_nodes", merge_all_nodes, root_graphs)
+    stage("merge_nodes_40_chunks", merge_nodes, *make_chunked_graph(max(size // 40, 1)))
+    stage("collapse_equivalent_nodes", collapse_all_nodes, root_graphs)
+    stage("write_dot", write_all_dot, root_graphs)
+    stage("write_json", write_all_json, root_graphs)
+    if graphviz_dir:
+        stage("render_svg", render_all, root_graphs, graphviz_dir, ["svg"])
+    results.append(compact_memory(size, schedulers, triggerables, sendchanges))
+    return results
+
+
+def import_time(module, runs=5):
+    """Returns the fastest cumulative import time of module, in seconds, as
+       reported by `python -X importtime` over several runs. The first run
+       may include compiling the module, so it's discarded."""
+    times = []
+    for _ in range(runs + 1):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        for line in proc.stderr.splitlines():
+            # eg: "import time:       574 |       4893 | module"
+            fields = [field.strip() for field in line.split("|")]
+            if fields[-1] == module:
+                times.append(int(fields[1]) / 1000000.0)
+    return min(times[1:])
+
+
+def bench_startup(runs=5):
+    """Returns results for the import time of the module, and the time
+       that it takes to run the tool with --help."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "buildbot_scheduler_graph.py")
+    help_times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.run([sys.executable, script, "--help"], stdout=subprocess.DEVNULL, check=True)
+        help_times.append(time.time() - start)
+    return [
+        {"size": 0, "stage": "startup_import", "seconds": import_time("buildbot_scheduler_graph", runs),
+         "peak_memory": None},
+        {"size": 0, "stage": "startup_help", "seconds": min(help_times), "peak_memory": None},
+    ]
+
+
+def report(results, baseline=None):
+    baseline = dict(((r["size"], r["stage"]), r) for r in baseline or [])
+    print("%8s  %-26s %10s %12s %10s %s" % ("size", "stage", "seconds", "us/scheduler", "peak MB",
+                                          "vs baseline" if baseline else ""))
+    for r in results:
+        if "dict_memory" in r:
+            print("%8d  %-26s %.1fMB as dicts vs %.1fMB compact + %.1fMB of names (%.1fx, %.1fx with names)" % (
+                r["size"], r["stage"], r["dict_memory"] / 1e6, r["compact_memory"] / 1e6,
+                r["name_table_memory"] / 1e6, float(r["dict_memory"]) / r["compact_memory"],
+                float(r["dict_memory"]) / (r["compact_memory"] + r["name_table_memory"])))
+            continue
+        if r["size"]:
+            line = "%8d  %-26s %10.3f %12.2f %10.1f" % (
+                r["size"], r["stage"], r["seconds"], r["seconds"] / r["size"] * 1000000, r["peak_memory"] / 1e6)
+        else:
+            line = "%8s  %-26s %10.3f %12s %10s" % ("-", r["stage"], r["seconds"], "-", "-")
+        old = baseline.get((r["size"], r["stage"]))
+        if old and old["seconds"]:
+            line += " %10.2fx" % (r["seconds"] / old["seconds"])
+        print(line)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 5000, 10000, 20000])
+    parser.add_argument("-o", "--output", dest="output", help="Write the results to this JSON file")
+    parser.add_argument("-c", "--compare", dest="compare", help="Compare to the results in this JSON file")
+    parser.add_argument("--startup", dest="startup", action="store_true", default=False,
+                        help="Also benchmark how long the tool takes to start up")
+    parser.add_argument("--graphviz-dir", dest="graphviz_dir",
+                        help="Also benchmark rendering SVGs with Graphviz, into this directory")
+    parser.add_argument("--chunks", dest="chunks", type=int, default=4,
+                        help="Split each chunked builder in the config into this many chunks")
+    args = parser.parse_args()
+
+    results = []
+    if args.startup:
+        results.extend(bench_startup())
+    for size in args.sizes:
+        results.extend(bench(size, args.graphviz_dir, args.chunks))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "version": __version__,
+                "python": platform.python_version(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
-from collections import defaultdict
-from copy import deepcopy
-from imp import load_source
+from array import array
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+import hashlib
+import importlib.machinery
+import importlib.util
 import json
 import logging
 import os
 import os.path
 import re
 import sys
+import time
+import traceback
+
+# multiprocessing, shutil, subprocess and tempfile are only imported where
+# they're used, so that runs that only write data formats start up quickly.
 
 __version__ = "1.0"
 
@@ -14,12 +23,105 @@ logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s")
 log = logging.getLogger(__name__)
 
 grouped_builder_patterns = [
-    "(?P<basename>.*)[-_ ]\d+/\d+$",
-    "(?P<basename>.*)[-_ ]\d+$",
-    "(?P<basename>.*-xulrunner)_.*(source|build)",
+    r"(?P<basename>.*)[-_ ]\d+/\d+$",
+    r"(?P<basename>.*)[-_ ]\d+$",
+    r"(?P<basename>.*-xulrunner)_.*(source|build)",
 ]
 
-def parse_schedulers(schedulers, triggerables={}, sendchanges={}):
+# Per-element details of what the tool is doing are sent here, but only
+# if a trace file has been set up with enable_trace.
+trace_log = logging.getLogger("%s.trace" % __name__)
+trace_log.propagate = False
+trace_log.setLevel(logging.WARNING)
+
+
+def enable_trace(filename):
+    """Writes trace events to filename, as JSON, one per line."""
+    handler = logging.FileHandler(filename, mode="w")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log.addHandler(handler)
+    trace_log.setLevel(logging.DEBUG)
+
+
+def trace(event, **fields):
+    """Records a trace event. Callers in loops should check whether tracing
+       is enabled first, so that they don't pay for building the fields."""
+    fields["event"] = event
+    trace_log.debug(json.dumps(fields, sort_keys=True))
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes, or None
+       on platforms where it isn't available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kilobytes, but OS X reports it in bytes.
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
+
+class StageTimings:
+    """Records how long each stage of a run takes, along with the peak RSS at
+       the end of it and any other information that the stage provides (eg:
+       the number of nodes and edges it worked on). Anything in context is
+       added to every record, eg: to say which master a stage was for."""
+    def __init__(self):
+        self.records = []
+        self.context = {}
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Times the code run inside of it as the stage called name. The
+           record is yielded, so that more information can be added to it."""
+        record = dict(self.context, stage=name, **info)
+        start = time.time()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.time() - start
+            record["peak_rss"] = peak_rss()
+            self.records.append(record)
+
+    def add(self, name, seconds, **info):
+        """Records a stage that was timed elsewhere, eg: in another process."""
+        record = dict(self.context, stage=name, seconds=seconds, **info)
+        record.setdefault("peak_rss", None)
+        self.records.append(record)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"stages": self.records}, f, indent=2, sort_keys=True)
+
+    def summary(self, slowest=10):
+        """Returns a table of the total time taken by each stage, followed by
+           the slowest individual graphs."""
+        totals = OrderedDict()
+        for r in self.records:
+            total = totals.setdefault(r["stage"], {"count": 0, "seconds": 0.0, "max": 0.0, "peak_rss": 0})
+            total["count"] += 1
+            total["seconds"] += r["seconds"]
+            total["max"] = max(total["max"], r["seconds"])
+            total["peak_rss"] = max(total["peak_rss"], r["peak_rss"] or 0)
+        lines = ["%-20s %8s %10s %10s %12s" % ("stage", "count", "total s", "max s", "peak RSS MB")]
+        for stage, total in totals.items():
+            lines.append("%-20s %8d %10.3f %10.3f %12.1f" % (
+                stage, total["count"], total["seconds"], total["max"], total["peak_rss"] / 1e6))
+        graphs = sorted((r for r in self.records if "graph" in r), key=lambda r: r["seconds"], reverse=True)
+        if graphs:
+            lines.append("")
+            lines.append("%-20s %10s %8s %8s  %s" % ("slowest graphs", "seconds", "nodes", "edges", "graph"))
+            for r in graphs[:slowest]:
+                graph = "%s: %s" % (r["master"], r["graph"]) if "master" in r else r["graph"]
+                lines.append("%-20s %10.3f %8s %8s  %s" % (
+                    r["stage"], r["seconds"], r.get("nodes", ""), r.get("edges", ""), graph))
+        return "\n".join(lines) + "\n"
+
+
+def parse_schedulers(schedulers, triggerables={}, sendchanges={}, changesources={}):
     """Parses Scheduler data into a dict whose keys are the name of
        each Scheduler and whose values are a dict with the following keys:
         * nodes - A set of every node that needed to graph this Scheduler.
@@ -29,99 +131,335 @@ def parse_schedulers(schedulers, triggerables={}, sendchanges={}):
                   edge between the Scheduler and each of the builders that
                   it notifies. There is also an edge between the Scheduler and
                   each upstream that it may have.
+
+       triggerables, sendchanges and changesources map Scheduler names to
+       the builders that trigger them, the builders that send changes to
+       them, and the ChangeSources that notify them, respectively (see
+       read_mapping). Each ChangeSource gets a root graph of its own,
+       which the Schedulers it notifies are merged into.
     """
     graph_info = {}
+    # Index Schedulers by name up front so that resolving a Dependent
+    # Scheduler's upstream doesn't require scanning every other Scheduler.
+    schedulers_by_name = defaultdict(list)
+    for s in schedulers:
+        schedulers_by_name[s.name].append(s)
+
+    # Only per-Scheduler summaries are logged, and only if they'd be shown.
+    logging_info = log.isEnabledFor(logging.INFO)
+    tracing = trace_log.isEnabledFor(logging.DEBUG)
     for s in schedulers:
         # Some schedulers have the same name as their builders, so let"s be sure
         # to avoid conflicts
         scheduler_name = "%s scheduler" % s.name
-        log.info("%s: Creating graph", scheduler_name)
         graph = graph_info[scheduler_name] = defaultdict(set)
         graph["nodes"].add(scheduler_name)
-        graph_info[scheduler_name]["root"] = True
+        graph["root"] = True
         for builder in s.builderNames:
-            log.info("%s: Adding Builder %s", scheduler_name, builder)
             graph["nodes"].add(builder)
             graph["edges"].add((scheduler_name, builder))
         # Connect Dependent Schedulers together
         if getattr(s, "upstream_name", None):
-            log.debug("%s: Connecting to Dependent Scheduler %s", scheduler_name, s.upstream_name)
-            graph_info[scheduler_name]["root"] = False
-            for upstream in schedulers:
-                if upstream.name == s.upstream_name:
-                    for builder in upstream.builderNames:
-                        log.info("%s: Adding Builder %s", scheduler_name, builder)
-                        graph["nodes"].add(builder)
-                        graph["edges"].add((builder, scheduler_name))
+            kind = "Dependent"
+            graph["root"] = False
+            upstream_builders = []
+            for upstream in schedulers_by_name.get(s.upstream_name, []):
+                upstream_builders.extend(upstream.builderNames)
         # Connect AggregatingScheduler Builders together
         elif getattr(s, "upstreamBuilders", None):
-            log.debug("%s: Adding Upstream Builders from Aggregating Scheduler", scheduler_name)
-            graph_info[scheduler_name]["root"] = False
-            for builder in s.upstreamBuilders:
-                log.info("%s: Adding Builder %s", scheduler_name, builder)
-                graph["nodes"].add(builder)
-                graph["edges"].add((builder, scheduler_name))
+            kind = "AggregatingScheduler"
+            graph["root"] = False
+            upstream_builders = s.upstreamBuilders
         # Triggerables need to be identified after AggregatingScheduler because
         # they share a "trigger" method.
         elif getattr(s, "trigger", None):
-            log.debug("%s: Looking for Triggerable Builders", scheduler_name)
-            graph_info[scheduler_name]["root"] = False
-            for builder in triggerables.get(s.name, []):
-                log.info("%s: Adding Builder %s", scheduler_name, builder)
-                graph["nodes"].add(builder)
-                graph["edges"].add((builder, scheduler_name))
+            kind = "Triggerable"
+            graph["root"] = False
+            upstream_builders = triggerables.get(s.name, [])
         # If this is a plainer scheduler, it may still be triggered by a
         # Sendchange.
         else:
-            log.debug("%s: Looking for Sendchanges", scheduler_name)
-            for builder in sendchanges.get(s.name, []):
-                graph_info[scheduler_name]["root"] = False
-                log.info("%s: Adding Builder %s", scheduler_name, builder)
-                graph["nodes"].add(builder)
-                graph["edges"].add((builder, scheduler_name))
+            kind = "Scheduler"
+            upstream_builders = sendchanges.get(s.name, [])
+            if upstream_builders:
+                graph["root"] = False
+        for builder in upstream_builders:
+            graph["nodes"].add(builder)
+            graph["edges"].add((builder, scheduler_name))
+        # Only plain Schedulers listen to ChangeSources.
+        upstream_changesources = changesources.get(s.name, []) if kind == "Scheduler" else []
+        for changesource in upstream_changesources:
+            changesource_name = "%s changesource" % changesource
+            if changesource_name not in graph_info:
+                changesource_graph = graph_info[changesource_name] = defaultdict(set)
+                changesource_graph["nodes"].add(changesource_name)
+                changesource_graph["edges"] = set()
+                changesource_graph["root"] = True
+            graph["nodes"].add(changesource_name)
+            graph["edges"].add((changesource_name, scheduler_name))
+            graph["root"] = False
+
+        if logging_info:
+            log.info("%s: Created graph for %s with %d Builders and %d upstream Builders",
+                     scheduler_name, kind, len(s.builderNames), len(upstream_builders))
+        if tracing:
+            trace("scheduler", name=scheduler_name, kind=kind, root=graph["root"],
+                  builders=list(s.builderNames), upstream_builders=list(upstream_builders),
+                  changesources=list(upstream_changesources))
 
     return graph_info
 
 
-def merge_graph_info(graph_info):
-    # We"re only going to be returning root Schedulers, but we need somewhere
-    # to do all of the merging in the meantime, including merging one non-root
-    # Scheduler into another.
-    new_graph_info = deepcopy(graph_info)
-    for s in graph_info:
-        # Root Schedulers never need to be merged
-        if graph_info[s]["root"] == True:
-            pass
+class MergeIndex:
+    """Indexes which Schedulers in graph_info (as returned by
+       parse_schedulers) are downstream of which, and which root graphs
+       each Scheduler was merged into the last time they were merged. As
+       long as Schedulers are added to and removed from graph_info through
+       the index, a few roots can be merged again without looking at the
+       rest of the config.
+
+       If table (a NameTable) is given, or graph_info already holds
+       CompactGraphs, Schedulers added through the index are stored in
+       graph_info as CompactGraphs that use it, and the index refers to
+       nodes by their ids rather than their names, so walking it never has
+       to expand a CompactGraph."""
+    __slots__ = ("graph_info", "table", "owners", "waiters", "merged", "roots_of")
+
+    def __init__(self, graph_info, table=None):
+        if table is None:
+            # A graph_info that's already compact is indexed by id too.
+            table = next((info.table for info in graph_info.values() if isinstance(info, CompactGraph)), None)
+        self.graph_info = graph_info
+        self.table = table
+        # The Schedulers that notify each node. Each graph also owns its own
+        # node, which is how ChangeSources notify their Schedulers.
+        self.owners = defaultdict(set)
+        # The non-root Schedulers that each node is upstream of.
+        self.waiters = defaultdict(set)
+        # The Schedulers that were merged into each root's graph, and the
+        # roots that each Scheduler was merged into, by name.
+        self.merged = {}
+        self.roots_of = defaultdict(set)
+        for s, info in graph_info.items():
+            self._index(s, info)
+
+    def _key(self, name):
+        return name if self.table is None else self.table.intern(name)
+
+    def _name(self, key):
+        return key if self.table is None else self.table.names[key]
+
+    def _edges(self, info):
+        # Returns the edges of one of graph_info's graphs, as pairs of keys.
+        if self.table is None:
+            return info["edges"]
+        if isinstance(info, CompactGraph) and info.table is self.table:
+            return info.edge_pairs()
+        intern = self.table.intern
+        return [(intern(upstream), intern(downstream)) for upstream, downstream in info["edges"]]
+
+    def _index(self, s, info):
+        key = self._key(s)
+        self.owners[key].add(key)
+        for upstream, downstream in self._edges(info):
+            if upstream == key:
+                self.owners[downstream].add(key)
+            elif downstream == key and not info["root"]:
+                self.waiters[upstream].add(key)
 
-        log.info("%s: Evaluating for graph merging", s)
-        # Any other Schedulers need to find the Scheduler that is upstream
-        # of them.
-        for other_s in graph_info:
-            # If we see ourselves, abort!
-            if s == other_s:
+    def _unindex(self, s, info):
+        key = self._key(s)
+        _discard(self.owners, key, key)
+        for upstream, downstream in self._edges(info):
+            if upstream == key:
+                _discard(self.owners, downstream, key)
+            elif downstream == key and not info["root"]:
+                _discard(self.waiters, upstream, key)
+
+    def add(self, s, info):
+        """Adds Scheduler s to graph_info, replacing it if it's already
+           there."""
+        if s in self.graph_info:
+            self.remove(s)
+        if self.table is not None and not isinstance(info, CompactGraph):
+            info = CompactGraph(self.table, info["nodes"], info["edges"], info["root"])
+        self.graph_info[s] = info
+        self._index(s, info)
+
+    def remove(self, s):
+        """Removes Scheduler s from graph_info."""
+        self._unindex(s, self.graph_info.pop(s))
+
+    def upstreams(self, s):
+        """Returns the names of the nodes directly upstream of Scheduler s."""
+        key = self._key(s)
+        return set(self._name(upstream) for upstream, downstream in self._edges(self.graph_info[s])
+                   if downstream == key)
+
+    def has_waiters(self, node):
+        """Returns whether any non-root Scheduler is downstream of node."""
+        return bool(self.waiters.get(self._key(node)))
+
+    def _downstreams(self, key):
+        # Returns the keys of the non-root Schedulers directly downstream of
+        # the Scheduler with the given key.
+        found = set(self.waiters.get(key, ()))
+        for upstream, downstream in self._edges(self.graph_info[self._name(key)]):
+            if upstream == key:
+                found.update(self.waiters.get(downstream, ()))
+        found.discard(key)
+        return found
+
+    def downstreams(self, s):
+        """Returns the non-root Schedulers directly downstream of s."""
+        return set(self._name(key) for key in self._downstreams(self._key(s)))
+
+    def upstream_roots(self, s):
+        """Returns the roots that Scheduler s should be merged into, as far
+           as is known from the last time they were merged: the roots of the
+           Schedulers that notify its upstreams."""
+        key = self._key(s)
+        roots = set()
+        for upstream, downstream in self._edges(self.graph_info[s]):
+            if downstream != key:
                 continue
-            log.debug("%s: Looking at nodes from %s", s, other_s)
-            # If the upstream side of any edge appears in another Scheduler"s
-            # builders, we should merge this one into it.
-            for edge in graph_info[s]["edges"]:
-                if edge[0] in new_graph_info[other_s]["nodes"]:
-                    log.info("%s: Found matching node in %s, merging", s, other_s)
-                    new_graph_info[other_s]["nodes"].update(new_graph_info[s]["nodes"])
-                    new_graph_info[other_s]["edges"].update(new_graph_info[s]["edges"])
-                    break
-            else:
-                log.debug("%s: No matching nodes, not merging", s)
+            for owner in self.owners.get(upstream, ()):
+                owner = self._name(owner)
+                if self.graph_info[owner]["root"]:
+                    roots.add(owner)
+                else:
+                    roots.update(self.roots_of.get(owner, ()))
+        return roots
 
-    return {s:info for s,info in new_graph_info.iteritems() if info["root"]}
+    def walk(self, root):
+        """Finds every Scheduler that's merged into root's graph, by walking
+           its downstream Schedulers once, and records them."""
+        self.forget(root)
+        key = self._key(root)
+        seen = set([key])
+        pending = [key]
+        while pending:
+            for other in self._downstreams(pending.pop()):
+                if other not in seen:
+                    seen.add(other)
+                    pending.append(other)
+        seen = set(self._name(other) for other in seen)
+        self.merged[root] = seen
+        for s in seen:
+            self.roots_of[s].add(root)
+        return seen
 
+    def forget(self, root):
+        """Forgets which Schedulers were merged into root's graph."""
+        for s in self.merged.pop(root, ()):
+            _discard(self.roots_of, s, root)
 
-def merge_nodes(orig_nodes, orig_edges, merge_pattern=None):
-    transformations = set()
-    r = re.compile(merge_pattern)
-    # Organize the nodes and edges to make them easier to work with
+
+def _discard(index, key, value):
+    # Removes value from one of a MergeIndex's sets, without leaving empty
+    # sets behind.
+    values = index.get(key)
+    if values is not None:
+        values.discard(value)
+        if not values:
+            del index[key]
+
+
+def _union_graphs(graphs):
+    # Returns the union of the nodes and edges of graphs. CompactGraphs are
+    # unioned by id, and the ids are only turned into names once, for the
+    # result.
+    nodes = set()
+    edges = set()
+    compact = {}
+    for graph in graphs:
+        if isinstance(graph, CompactGraph):
+            node_ids, edge_ids = compact.setdefault(graph.table, (set(), set()))
+            node_ids.update(graph.data[:graph.node_count])
+            edge_ids.update(graph.edge_pairs())
+        else:
+            nodes.update(graph["nodes"])
+            edges.update(graph["edges"])
+    for table, (node_ids, edge_ids) in compact.items():
+        names = table.names
+        nodes.update(names[i] for i in node_ids)
+        edges.update((names[left], names[right]) for left, right in edge_ids)
+    return nodes, edges
+
+
+def merge_graph_info(graph_info, roots=None, index=None):
+    """Merges every non-root Scheduler into the root Scheduler(s) upstream of
+       it. Takes and returns a dict in the format that parse_schedulers
+       returns, but the returned dict only contains root Schedulers. If
+       roots is given, only the graphs of those root Schedulers are built.
+
+       A Scheduler is downstream of another if any of its upstream builders
+       is notified by the other one. Each root's graph is built by walking
+       its downstream Schedulers once, so chains and diamonds of any depth
+       are merged regardless of the order of graph_info.
+
+       index is a MergeIndex of graph_info. If it isn't given, one is built,
+       which means looking at every Scheduler in graph_info.
+    """
+    if index is None:
+        index = MergeIndex(graph_info)
+
+    # We're only going to be returning root Schedulers, so each one gets
+    # the nodes and edges of everything that's downstream of it.
+    tracing = trace_log.isEnabledFor(logging.DEBUG)
+    new_graph_info = {}
+    for s in (graph_info if roots is None else roots):
+        if s not in graph_info or not graph_info[s]["root"]:
+            continue
+        seen = index.walk(s)
+        nodes, edges = _union_graphs(graph_info[other_s] for other_s in seen)
+        log.info("%s: Merged %d downstream Schedulers", s, len(seen) - 1)
+        if tracing:
+            trace("merge_graph", root=s, schedulers=sorted(seen))
+        new_graph_info[s] = {"nodes": nodes, "edges": edges, "root": True}
+
+    return new_graph_info
+
+
+# Compiled merge patterns, keyed by the tuple of patterns they were compiled
+# from, so that merging many graphs doesn't recompile them every time.
+_compiled_merge_patterns = {}
+
+
+def compile_merge_patterns(patterns):
+    """Compiles a list of merge patterns, returning a tuple of the compiled
+       patterns and a prefilter. The prefilter is a single alternation of all
+       of the patterns that tells whether a node matches any of them, or None
+       if the patterns can't be combined."""
+    patterns = tuple(patterns)
+    if patterns not in _compiled_merge_patterns:
+        compiled = [re.compile(p) for p in patterns]
+        # Group names can't be repeated within a single expression, so they
+        # need to be stripped to combine the patterns.
+        try:
+            prefilter = re.compile("|".join(
+                "(?:%s)" % re.sub(r"\(\?P<\w+>", "(?:", p) for p in patterns
+            ))
+        except re.error:
+            prefilter = None
+        _compiled_merge_patterns[patterns] = (compiled, prefilter)
+    return _compiled_merge_patterns[patterns]
+
+
+def _neighbor_signature(n, preds, succs):
+    # References to the node itself are replaced with None, so that nodes
+    # with self-referencing edges can be compared to each other.
+    return (
+        frozenset(None if p == n else p for p in preds[n]),
+        frozenset(None if s == n else s for s in succs[n]),
+    )
+
+
+def _find_renames(r, candidates, preds, succs, tracing=False):
+    renames = {}
+    unmergeable = 0
     node_groups = defaultdict(list)
-    node_edges = defaultdict(list)
-    for n in orig_nodes:
+    for n in sorted(candidates):
         m = r.match(n)
         if m:
             groups = m.groupdict()
@@ -129,115 +467,1590 @@ def merge_nodes(orig_nodes, orig_edges, merge_pattern=None):
             if "extra" in groups:
                 basename += groups["extra"]
             node_groups[basename].append(n)
-    for e in orig_edges:
-        node_edges[e[0]].append(e)
-        node_edges[e[1]].append(e)
 
     # Do the merging, group by group.
-    for basename, nodes in node_groups.iteritems():
+    for basename, nodes in node_groups.items():
         # Can't merge a group with only one item!
         if len(nodes) < 2:
             continue
 
-        mergeable = True
-        log.info("%s: Trying to merge node group", basename)
         # Nodes can only be merged together if all nodes in the group have
         # the same edges.
-        required_edges = node_edges[nodes[0]]
+        required = _neighbor_signature(nodes[0], preds, succs)
         for n in nodes[1:]:
-            if len(node_edges[n]) != len(required_edges):
-                log.info("%s: Number of edges is different than %s", basename, n)
-                mergeable = False
-                break
-            # Replace the current node with the first node in all of the edges, for purposes of easy comparison
-            replaced_edges = [(left.replace(n, nodes[0]), right.replace(n, nodes[0])) for left, right in node_edges[n]]
-            if set(required_edges) != set(replaced_edges):
-                log.info("%s: Edge content is different than %s", basename, n)
-                log.debug("%s: %s vs %s", basename, required_edges, replaced_edges)
-                mergeable = False
+            if _neighbor_signature(n, preds, succs) != required:
+                unmergeable += 1
+                if tracing:
+                    trace("merge_group", pattern=r.pattern, basename=basename, nodes=nodes,
+                          mergeable=False, different=n)
                 break
-
-        # If the group is mergeable we need to add the basename to the list of
-        # nodes, and add the deduplicated edges with the new node name.
-        if mergeable:
-            log.info("%s: Mergable!", basename)
+        # If the group is mergeable every node in it gets renamed to the
+        # basename.
+        else:
+            if tracing:
+                trace("merge_group", pattern=r.pattern, basename=basename, nodes=nodes, mergeable=True)
             for n in nodes:
-                transformations.add((n, basename))
+                renames[n] = basename
+
+    return renames, unmergeable
+
+
+def merge_nodes(orig_nodes, orig_edges, merge_pattern=None, members=None):
+    """Merges groups of nodes that have identical edges and whose names match
+       a merge pattern into a single node, named after the pattern's
+       "basename" group. merge_pattern may be a single pattern or a list of
+       them, and defaults to grouped_builder_patterns. Patterns are applied
+       in order, each one to the result of the previous one.
+
+       If members is a dict, it's filled in with the name of each merged
+       node and the set of original nodes that were merged into it.
+
+       Returns a tuple of the merged nodes and edges.
+    """
+    if merge_pattern is None:
+        merge_pattern = grouped_builder_patterns
+    elif not isinstance(merge_pattern, (list, tuple)):
+        merge_pattern = [merge_pattern]
+    patterns, prefilter = compile_merge_patterns(merge_pattern)
+
+    nodes = set(orig_nodes)
+    edges = set(orig_edges)
+    # Organize the edges to make them easier to work with. These are kept up
+    # to date as each pattern is applied, rather than rebuilt for each one.
+    preds = defaultdict(set)
+    succs = defaultdict(set)
+    for left, right in edges:
+        succs[left].add(right)
+        preds[right].add(left)
+    # Only nodes that match at least one of the patterns can be merged.
+    candidates = set(n for n in nodes if prefilter is None or prefilter.match(n))
+
+    tracing = trace_log.isEnabledFor(logging.DEBUG)
+    merged = unmergeable = 0
+    for r in patterns:
+        renames, pattern_unmergeable = _find_renames(r, candidates, preds, succs, tracing)
+        unmergeable += pattern_unmergeable
+        if not renames:
+            continue
+
+        merged += len(set(renames.values()))
+        if members is not None:
+            for n, basename in renames.items():
+                originals = members.pop(n, None) or set([n])
+                members.setdefault(basename, set()).update(originals)
+        # Only edges that touch a renamed node need to change.
+        changed = set()
+        for n in renames:
+            changed.update((p, n) for p in preds[n])
+            changed.update((n, s) for s in succs[n])
+        for left, right in changed:
+            edges.discard((left, right))
+            succs[left].discard(right)
+            preds[right].discard(left)
+        for n in renames:
+            nodes.discard(n)
+            candidates.discard(n)
+            preds.pop(n, None)
+            succs.pop(n, None)
+        for left, right in changed:
+            left = renames.get(left, left)
+            right = renames.get(right, right)
+            edges.add((left, right))
+            succs[left].add(right)
+            preds[right].add(left)
+        for n in set(renames.values()):
+            nodes.add(n)
+            if prefilter is None or prefilter.match(n):
+                candidates.add(n)
+
+    if merged or unmergeable:
+        log.info("Merged %d groups of nodes, leaving %d nodes; %d groups had different edges",
+                 merged, len(nodes), unmergeable)
+    return nodes, edges
+
+
+def _collapsed_name(group, taken):
+    # Name the node after what the group's names have in common, without
+    # any separators or partial numbers it ends in (eg: "foo 1/2" and
+    # "foo 2/2" become "foo").
+    prefix = os.path.commonprefix(group)
+    if any(len(n) > len(prefix) and n[len(prefix)].isdigit() for n in group):
+        prefix = prefix.rstrip("0123456789")
+    name = prefix.rstrip(" -_/.:,")
+    if not name or name in taken:
+        name = "%s (+%d)" % (group[0], len(group) - 1)
+    unique = name
+    i = 1
+    while unique in taken:
+        i += 1
+        unique = "%s %d" % (name, i)
+    return unique
 
-    log.debug("Performing transformations: %s", transformations)
-    merged_nodes = set()
-    merged_edges = set()
+
+def collapse_equivalent_nodes(orig_nodes, orig_edges, members=None, exclude=()):
+    """Collapses every group of nodes with exactly the same predecessors and
+       successors into a single node, regardless of their names. Nodes with
+       no edges, and nodes in exclude, are left alone. Each collapsed node is
+       named after the common prefix of the nodes in it, or after the first
+       of them if that's empty or already taken.
+
+       Unlike merge_nodes this makes a single pass over the graph, so
+       nodes that only become equivalent once others are collapsed aren't
+       collapsed themselves. members is filled in the same way as
+       merge_nodes does, and can be the same dict.
+
+       Returns a tuple of the collapsed nodes and edges.
+    """
+    preds = defaultdict(set)
+    succs = defaultdict(set)
+    for left, right in orig_edges:
+        succs[left].add(right)
+        preds[right].add(left)
+
+    groups = defaultdict(list)
     for n in orig_nodes:
-        for before, after in transformations:
-            n = n.replace(before, after)
-        merged_nodes.add(n)
-    for e in orig_edges:
-        for before, after in transformations:
-            e = (e[0].replace(before, after), e[1].replace(before, after))
-        merged_edges.add(e)
+        if n in exclude or (n not in preds and n not in succs):
+            continue
+        groups[(frozenset(preds.get(n, ())), frozenset(succs.get(n, ())))].append(n)
+
+    renames = {}
+    taken = set(orig_nodes)
+    tracing = trace_log.isEnabledFor(logging.DEBUG)
+    # Groups are named in a consistent order, so that collisions are always
+    # resolved the same way.
+    for group in sorted(sorted(group) for group in groups.values()):
+        if len(group) < 2:
+            continue
+        taken.difference_update(group)
+        name = _collapsed_name(group, taken)
+        taken.add(name)
+        if tracing:
+            trace("collapse_group", name=name, nodes=group)
+        for n in group:
+            renames[n] = name
+            if members is not None:
+                members.setdefault(name, set()).update(members.pop(n, None) or set([n]))
+
+    if renames:
+        log.info("Collapsed %d nodes into %d", len(renames), len(set(renames.values())))
+    nodes = set(renames.get(n, n) for n in orig_nodes)
+    edges = set((renames.get(left, left), renames.get(right, right)) for left, right in orig_edges)
+    return nodes, edges
+
+
+def build_root_graphs(graph_info, merge_patterns=None, roots=None, timings=None, collapse=False, index=None):
+    """Turns the result of parse_schedulers into the graphs that get
+       rendered: one per root Scheduler (or only those in roots, if given),
+       as merged by merge_graph_info and with its nodes merged by
+       merge_nodes. As well as "nodes" and "edges", each graph has "members"
+       as filled in by merge_nodes, "schedulers", the set of its nodes that
+       are Schedulers, and "changesources", the set of its nodes that are
+       ChangeSources. If collapse is True, equivalent builders are
+       collapsed by collapse_equivalent_nodes after merging. index is passed
+       on to merge_graph_info. If timings (a StageTimings) is given, each
+       step is recorded in it."""
+    if timings is None:
+        timings = StageTimings()
+    all_schedulers = graph_info.keys()
+    with timings.stage("merge_graph_info", schedulers=len(all_schedulers)) as record:
+        graph_info = merge_graph_info(graph_info, roots, index)
+        record["roots"] = len(graph_info)
+    for name, info in graph_info.items():
+        with timings.stage("merge_nodes", graph=name, nodes=len(info["nodes"]), edges=len(info["edges"])) as record:
+            _merge_graph_nodes(info, merge_patterns, all_schedulers, collapse)
+            record["merged_nodes"] = len(info["nodes"])
+            record["merged_edges"] = len(info["edges"])
+    return graph_info
+
+
+def _merge_graph_nodes(info, merge_patterns, all_schedulers, collapse=False):
+    members = info["members"] = {}
+    info["nodes"], info["edges"] = merge_nodes(info["nodes"], info["edges"], merge_patterns, members)
+    # Every graph in graph_info is for a Scheduler, except for the ones that
+    # parse_schedulers creates for ChangeSources.
+    found = set(
+        n for n in info["nodes"]
+        if n in all_schedulers or not all_schedulers.isdisjoint(members.get(n, ()))
+    )
+    info["changesources"] = set(n for n in found if n.endswith(" changesource"))
+    info["schedulers"] = found - info["changesources"]
+    if collapse:
+        # Schedulers and ChangeSources are left alone, so that every one can
+        # still be found in the graph.
+        info["nodes"], info["edges"] = collapse_equivalent_nodes(info["nodes"], info["edges"], members, found)
+
+
+def combine_graph_info(graph_infos):
+    """Combines the results of several parse_schedulers calls (eg: from
+       different masters) into one. Schedulers with the same name are
+       combined into a single one, which is only a root if all of them
+       were."""
+    combined = {}
+    for graph_info in graph_infos:
+        for s, info in graph_info.items():
+            if s not in combined:
+                combined[s] = {"nodes": set(), "edges": set(), "root": True}
+            combined[s]["nodes"].update(info["nodes"])
+            combined[s]["edges"].update(info["edges"])
+            combined[s]["root"] = combined[s]["root"] and info["root"]
+    return combined
+
+
+def all_in_one_graphs(root_graphs, max_nodes=None, name="all-in-one"):
+    """Combines the graphs returned by build_root_graphs into a single graph
+       named `name`, in which each root's nodes are a cluster named after
+       the root. Nodes that are in more than one root's graph appear once,
+       outside of the clusters.
+
+       If max_nodes is given, the roots are split into several graphs
+       ("all-in-one 1", "all-in-one 2", ...) of at most that many nodes,
+       unless a single root has more. Roots that share nodes are kept in
+       the same graph where they fit.
+
+       Returns a dict in the same format as build_root_graphs, with
+       "clusters" in each graph as write_dot takes."""
+    # Roots that share nodes form components, found with union-find.
+    parent = dict((root, root) for root in root_graphs)
+
+    def find(root):
+        while parent[root] != root:
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    first_root = {}
+    for root in sorted(root_graphs):
+        for n in root_graphs[root]["nodes"]:
+            other = first_root.setdefault(n, root)
+            if other != root:
+                parent[find(root)] = find(other)
+    components = defaultdict(list)
+    for root in sorted(root_graphs):
+        components[find(root)].append(root)
+
+    # Pack the components into chunks, splitting any that are too big on
+    # their own into their roots.
+    units = []
+    for _, roots in sorted(components.items()):
+        component_nodes = set()
+        for root in roots:
+            component_nodes.update(root_graphs[root]["nodes"])
+        if max_nodes is None or len(component_nodes) <= max_nodes:
+            units.append((roots, component_nodes))
+        else:
+            units.extend(([root], root_graphs[root]["nodes"]) for root in roots)
+    chunks = []
+    chunk_roots = []
+    chunk_nodes = set()
+    for roots, nodes in units:
+        if chunk_roots and max_nodes is not None and len(chunk_nodes | nodes) > max_nodes:
+            chunks.append(chunk_roots)
+            chunk_roots = []
+            chunk_nodes = set()
+        chunk_roots.extend(roots)
+        chunk_nodes.update(nodes)
+    if chunk_roots:
+        chunks.append(chunk_roots)
+
+    graphs = {}
+    for i, roots in enumerate(chunks):
+        info = {"nodes": set(), "edges": set(), "root": True, "members": {}, "schedulers": set(),
+                "changesources": set(), "clusters": {}}
+        node_roots = defaultdict(int)
+        for root in roots:
+            root_info = root_graphs[root]
+            info["nodes"].update(root_info["nodes"])
+            info["edges"].update(root_info["edges"])
+            info["schedulers"].update(root_info.get("schedulers", ()))
+            info["changesources"].update(root_info.get("changesources", ()))
+            for n, members in root_info.get("members", {}).items():
+                info["members"].setdefault(n, set()).update(members)
+            for n in root_info["nodes"]:
+                node_roots[n] += 1
+        for root in roots:
+            info["clusters"][root] = set(n for n in root_graphs[root]["nodes"] if node_roots[n] == 1)
+        graphs[name if len(chunks) == 1 else "%s %d" % (name, i + 1)] = info
+    return graphs
+
+
+def adjacency_index(graph_info):
+    """Indexes the edges of every graph in graph_info, as returned by
+       parse_schedulers or merge_graph_info. Returns a tuple of dicts that
+       map each node to the set of nodes directly upstream of it, and to
+       the set of nodes directly downstream of it."""
+    preds = defaultdict(set)
+    succs = defaultdict(set)
+    for info in graph_info.values():
+        for left, right in info["edges"]:
+            succs[left].add(right)
+            preds[right].add(left)
+    return preds, succs
+
+
+def _walk(start, neighbors, depth):
+    seen = set(start)
+    frontier = list(start)
+    while frontier and depth != 0:
+        next_frontier = []
+        for n in frontier:
+            for other in neighbors.get(n, ()):
+                if other not in seen:
+                    seen.add(other)
+                    next_frontier.append(other)
+        frontier = next_frontier
+        if depth is not None:
+            depth -= 1
+    return seen
+
+
+def focus_graph(graph_info, names, depth=None):
+    """Extracts the neighborhood of the named nodes from graph_info, as
+       returned by parse_schedulers: everything upstream of them and
+       everything downstream of them, up to depth edges away (or without
+       limit if depth is None). Schedulers and ChangeSources may be named
+       without their " scheduler" or " changesource" suffix. Raises
+       ValueError if any of the names aren't in any graph.
+
+       Returns a tuple of the nodes and the edges between them."""
+    preds, succs = adjacency_index(graph_info)
+    start = set()
+    unknown = []
+    for name in names:
+        if name in preds or name in succs:
+            start.add(name)
+        elif "%s scheduler" % name in graph_info:
+            start.add("%s scheduler" % name)
+        elif "%s changesource" % name in graph_info:
+            start.add("%s changesource" % name)
+        else:
+            unknown.append(name)
+    if unknown:
+        raise ValueError("Unknown builders or Schedulers: %s" % ", ".join(unknown))
+
+    nodes = _walk(start, preds, depth) | _walk(start, succs, depth)
+    edges = set()
+    for n in nodes:
+        edges.update((n, s) for s in succs.get(n, ()) if s in nodes)
+    return nodes, edges
+
+
+def strongly_connected_components(nodes, succs):
+    """Finds the strongly connected components of a graph with Tarjan's
+       algorithm, without recursion so that long chains can't overflow the
+       stack. succs maps each node to the nodes it has edges to. Returns a
+       list of components, each a list of nodes, in reverse topological
+       order: every component comes after all of the ones it has edges
+       to. Nodes are visited in sorted order, so the result is stable."""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for start in sorted(nodes):
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(sorted(succs.get(start, ()))))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(succs.get(child, ())))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        component.append(n)
+                        if n == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def _path_within(start, end, succs, component_of):
+    # Finds a shortest path from start to end that stays within their
+    # strongly connected component, returning it without start.
+    component = component_of[start]
+    previous = {start: None}
+    pending = [start]
+    while end not in previous:
+        next_pending = []
+        for n in pending:
+            for other in sorted(succs.get(n, ())):
+                if other not in previous and component_of[other] == component:
+                    previous[other] = n
+                    next_pending.append(other)
+        pending = next_pending
+    path = []
+    while end != start:
+        path.append(end)
+        end = previous[end]
+    path.reverse()
+    return path
+
+
+def analyze_graph_info(graph_info):
+    """Checks the result of parse_schedulers for problems, in time linear
+       in the size of the graphs (apart from sorting, to keep the results
+       stable). Returns a dict with the following keys:
+        * cycles - Each group of nodes that are upstream of themselves,
+                   sorted. merge_graph_info copes with these, but they're
+                   almost certainly mistakes.
+        * order - Every node in topological order, with the nodes in each
+                  cycle next to each other.
+        * unreachable_builders - Builders that no root Scheduler or
+                                 ChangeSource leads to.
+        * orphaned_schedulers - Non-root Schedulers that no root leads to,
+                                so they aren't in any merged graph.
+        * longest_chains - The longest chain of nodes downstream of each
+                           root, in order, starting with the root. Where a
+                           chain passes through a cycle, it goes round the
+                           cycle from where it enters to where it leaves.
+    """
+    preds, succs = adjacency_index(graph_info)
+    nodes = set()
+    for info in graph_info.values():
+        nodes.update(info["nodes"])
+
+    components = strongly_connected_components(nodes, succs)
+    component_of = {}
+    for i, component in enumerate(components):
+        for n in component:
+            component_of[n] = i
+    cycles = sorted(
+        sorted(component) for component in components
+        if len(component) > 1 or component[0] in succs.get(component[0], ())
+    )
+
+    # Components come out of Tarjan's algorithm downstream first, so the
+    # longest chain from each one can be found from the ones after it in
+    # a single pass.
+    chain_length = [0] * len(components)
+    chain_next = [None] * len(components)
+    for i, component in enumerate(components):
+        for n in component:
+            for other in succs.get(n, ()):
+                j = component_of[other]
+                if j != i and chain_length[j] + 1 > chain_length[i]:
+                    chain_length[i] = chain_length[j] + 1
+                    chain_next[i] = (n, other)
+
+    roots = sorted(s for s, info in graph_info.items() if info["root"])
+    longest_chains = {}
+    for root in roots:
+        chain = [root]
+        step = chain_next[component_of[root]]
+        while step:
+            # Within a cycle, the chain may leave from a different node than
+            # it arrived at, so it goes round the cycle to get there.
+            if step[0] != chain[-1]:
+                chain.extend(_path_within(chain[-1], step[0], succs, component_of))
+            chain.append(step[1])
+            step = chain_next[component_of[step[1]]]
+        longest_chains[root] = chain
+
+    reachable = set(roots)
+    pending = list(roots)
+    while pending:
+        for other in succs.get(pending.pop(), ()):
+            if other not in reachable:
+                reachable.add(other)
+                pending.append(other)
+
+    return {
+        "cycles": cycles,
+        "order": [n for component in reversed(components) for n in sorted(component)],
+        "unreachable_builders": sorted(n for n in nodes - reachable if n not in graph_info),
+        "orphaned_schedulers": sorted(s for s, info in graph_info.items()
+                                      if not info["root"] and s not in reachable),
+        "longest_chains": longest_chains,
+    }
+
+
+def build_focus_graph(graph_info, names, depth=None, merge_patterns=None, collapse=False):
+    """Like build_root_graphs, but builds a single graph of the neighborhood
+       of the named nodes, as found by focus_graph. The graph is named after
+       the nodes, with any characters that can't be in a filename replaced."""
+    nodes, edges = focus_graph(graph_info, names, depth)
+    name = re.sub(r"[/\\]", "_", "focus %s" % ", ".join(names))
+    info = {"nodes": nodes, "edges": edges, "root": True}
+    _merge_graph_nodes(info, merge_patterns, set(graph_info), collapse)
+    log.info("%s: Found %d nodes", name, len(info["nodes"]))
+    return {name: info}
+
+
+class NameTable:
+    """Interns node names, so that each name is only stored once no matter
+       how many graphs it's in, and can be referred to by a small integer."""
+    __slots__ = ("ids", "names")
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        """Returns the id of name, adding it to the table if necessary."""
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+
+class CompactGraph:
+    """A graph whose nodes are ids from a NameTable, which is usually shared
+       with many other graphs. Everything is stored in a single array: the
+       sorted node ids, followed by the sorted edges as pairs of ids.
+
+       It can be used wherever one of the graphs from parse_schedulers can,
+       but graph["nodes"] and graph["edges"] expand to sets of names every
+       time they're looked up, so code that handles many graphs (like
+       MergeIndex and merge_graph_info) works with the ids instead, and
+       only looks up the names of its results."""
+    __slots__ = ("table", "data", "node_count", "root")
+
+    def __init__(self, table, nodes=(), edges=(), root=True):
+        self.table = table
+        node_ids = sorted(set(table.intern(n) for n in nodes))
+        self.data = array("I", node_ids)
+        for left, right in sorted(set((table.intern(left), table.intern(right)) for left, right in edges)):
+            self.data.append(left)
+            self.data.append(right)
+        self.node_count = len(node_ids)
+        self.root = root
+
+    def node_ids(self):
+        return set(self.data[:self.node_count])
+
+    def edge_ids(self):
+        return set(self.edge_pairs())
+
+    def edge_pairs(self):
+        """Returns an iterator over the edges, as pairs of ids."""
+        # Pairing off a single iterator saves slicing the edges twice more.
+        edges = iter(self.data[self.node_count:])
+        return zip(edges, edges)
+
+    def __getitem__(self, key):
+        names = self.table.names
+        if key == "nodes":
+            return set(names[i] for i in self.data[:self.node_count])
+        if key == "edges":
+            edges = self.data[self.node_count:]
+            return set((names[left], names[right]) for left, right in zip(edges[::2], edges[1::2]))
+        if key == "root":
+            return self.root
+        raise KeyError(key)
+
+    def to_dict(self):
+        """Returns the graph in the format that parse_schedulers uses."""
+        return {"nodes": self["nodes"], "edges": self["edges"], "root": self.root}
+
+
+def compact_graph_info(graph_info, table=None):
+    """Converts each graph in graph_info (as returned by parse_schedulers) to
+       a CompactGraph, all sharing one NameTable."""
+    if table is None:
+        table = NameTable()
+    return dict(
+        (s, CompactGraph(table, info["nodes"], info["edges"], info["root"]))
+        for s, info in graph_info.items()
+    )
+
+
+def expand_graph_info(compact_info):
+    """Converts the result of compact_graph_info back to the format that
+       parse_schedulers returns."""
+    return dict((s, graph.to_dict()) for s, graph in compact_info.items())
+
+
+def quote_dot_id(name):
+    """Quotes a node name so that it can be used as an ID in a DOT file."""
+    return '"%s"' % name.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_dot(f, nodes, edges, clusters=None):
+    """Writes a graph to the file object f in DOT format. Nodes and edges
+       are written out one at a time, in sorted order.
+
+       clusters is an optional dict of cluster names and the set of nodes
+       in each, which are drawn together in a box labelled with the name.
+       Nodes that aren't in any cluster are drawn outside of them."""
+    f.write("digraph G {\n")
+    f.write("layout=dot;\n")
+    clustered = set()
+    for i, cluster in enumerate(sorted(clusters or {})):
+        f.write("subgraph %s {\n" % quote_dot_id("cluster_%d" % i))
+        f.write("label=%s;\n" % quote_dot_id(cluster))
+        for node in sorted(clusters[cluster]):
+            f.write("%s;\n" % quote_dot_id(node))
+        f.write("}\n")
+        clustered.update(clusters[cluster])
+    for node in sorted(nodes):
+        if node not in clustered:
+            f.write("%s;\n" % quote_dot_id(node))
+    for left, right in sorted(edges):
+        f.write("%s -> %s;\n" % (quote_dot_id(left), quote_dot_id(right)))
+    f.write("}\n")
+
+
+def _node_records(name, nodes, schedulers, members, clusters=None, changesources=()):
+    roots = set(clusters) if clusters else set([name])
+    for node in sorted(nodes):
+        if node in schedulers:
+            kind = "scheduler"
+        elif node in changesources:
+            kind = "changesource"
+        else:
+            kind = "builder"
+        yield {
+            "name": node,
+            "kind": kind,
+            "root": node in roots,
+            "members": sorted(members.get(node, ())),
+        }
+
+
+def write_json(f, name, nodes, edges, schedulers=(), members=None, clusters=None, changesources=()):
+    """Writes a graph to the file object f as JSON, one node or edge at a
+       time. Each node records its kind ("scheduler", "changesource" or
+       "builder", according to schedulers and changesources), whether
+       it's the graph's root Scheduler, and the nodes that were merged into
+       it, if any. If clusters is given (as write_dot takes), each cluster's
+       name is a root Scheduler, and the clusters are written out too."""
+    f.write('{"name": %s,\n' % json.dumps(name))
+    if clusters:
+        f.write(' "clusters": %s,\n' % json.dumps(
+            dict((c, sorted(clustered)) for c, clustered in clusters.items()), sort_keys=True))
+    f.write(' "nodes": [')
+    for i, record in enumerate(_node_records(name, nodes, schedulers, members or {}, clusters, changesources)):
+        f.write("%s\n  %s" % ("," if i else "", json.dumps(record, sort_keys=True)))
+    f.write('\n ],\n "edges": [')
+    for i, edge in enumerate(sorted(edges)):
+        f.write("%s\n  %s" % ("," if i else "", json.dumps(list(edge))))
+    f.write("\n ]\n}\n")
+
+
+def write_graphml(f, name, nodes, edges, schedulers=(), members=None, clusters=None, changesources=()):
+    """Writes a graph to the file object f as GraphML, with the same node
+       information as write_json. Because GraphML has no list type, merged
+       nodes are recorded as a JSON encoded list. Clusters aren't written,
+       but their root Schedulers are marked as roots."""
+    from xml.sax.saxutils import escape as xml_escape, quoteattr
+
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    f.write('  <key id="kind" for="node" attr.name="kind" attr.type="string"/>\n')
+    f.write('  <key id="root" for="node" attr.name="root" attr.type="boolean"/>\n')
+    f.write('  <key id="members" for="node" attr.name="members" attr.type="string"/>\n')
+    f.write('  <graph id=%s edgedefault="directed">\n' % quoteattr(name))
+    for record in _node_records(name, nodes, schedulers, members or {}, clusters, changesources):
+        f.write('    <node id=%s>' % quoteattr(record["name"]))
+        f.write('<data key="kind">%s</data>' % record["kind"])
+        f.write('<data key="root">%s</data>' % ("true" if record["root"] else "false"))
+        if record["members"]:
+            f.write('<data key="members">%s</data>' % xml_escape(json.dumps(record["members"])))
+        f.write('</node>\n')
+    for left, right in sorted(edges):
+        f.write('    <edge source=%s target=%s/>\n' % (quoteattr(left), quoteattr(right)))
+    f.write('  </graph>\n')
+    f.write('</graphml>\n')
+
+
+@lru_cache(maxsize=None)
+def find_dot():
+    """Returns the command to run Graphviz's dot with: $GRAPHVIZ_DOT if it's
+       set, otherwise dot as found in $PATH. It's only looked up once, no
+       matter how many graphs are rendered."""
+    if os.environ.get("GRAPHVIZ_DOT"):
+        return os.environ["GRAPHVIZ_DOT"]
+    import shutil
+    # If it can't be found, running it will fail with a clear enough error.
+    return shutil.which("dot") or "dot"
+
+
+def render_graph(name, nodes, edges, output_dir, formats, schedulers=(), members=None, clusters=None,
+                 changesources=()):
+    """Renders a graph into output_dir, once for each of the given formats
+       (eg: "dot", "json", "svg"), in files named after the graph. DOT, JSON
+       and GraphML files are written directly. Graphviz is run once for all
+       of the other formats, so the graph is only laid out once no matter
+       how many of them are requested.
+
+       schedulers and changesources are the sets of nodes that are
+       Schedulers and ChangeSources, and members is a dict as filled in by
+       merge_nodes; they're only used by the JSON and GraphML formats.
+       clusters is passed on to write_dot and write_json."""
+    if "dot" in formats:
+        with open(os.path.join(output_dir, "%s.dot" % name), "w") as f:
+            write_dot(f, nodes, edges, clusters)
+    if "json" in formats:
+        with open(os.path.join(output_dir, "%s.json" % name), "w") as f:
+            write_json(f, name, nodes, edges, schedulers, members, clusters, changesources)
+    if "graphml" in formats:
+        with open(os.path.join(output_dir, "%s.graphml" % name), "w") as f:
+            write_graphml(f, name, nodes, edges, schedulers, members, clusters, changesources)
+
+    formats = [fmt for fmt in formats if fmt not in ("dot", "json", "graphml")]
+    if not formats:
+        return
+
+    cmd = [find_dot()]
+    for fmt in formats:
+        cmd.append("-T%s" % fmt)
+        cmd.append("-o%s" % os.path.join(output_dir, "%s.%s" % (name, fmt)))
+    # stderr goes to a file rather than a pipe, so that Graphviz can't block
+    # on writing to it while we're still streaming the graph to it.
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr, encoding="utf-8")
+        write_dot(proc.stdin, nodes, edges, clusters)
+        proc.stdin.close()
+        proc.wait()
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError("%s exited with %d: %s" % (
+                " ".join(cmd), proc.returncode, stderr.read().decode("utf-8", "replace")))
+
+
+def _render_graph_job(job):
+    start = time.time()
+    try:
+        render_graph(*job)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return job[0], error, time.time() - start, peak_rss()
+
+
+# Name of the file in the output directory that records what was rendered
+# by the previous run.
+render_cache_filename = ".buildbot-scheduler-graph-cache.json"
+
+
+def graph_hash(nodes, edges, patterns=(), schedulers=(), members=None, clusters=None, changesources=()):
+    """Returns a hash of a graph's content and the way it's being rendered,
+       which is stable across runs. The output format isn't part of it, so
+       the same hash is recorded for each of a graph's files."""
+    members = sorted((n, sorted(m)) for n, m in (members or {}).items())
+    clusters = sorted((c, sorted(m)) for c, m in (clusters or {}).items())
+    content = json.dumps([sorted(nodes), sorted(edges), list(patterns),
+                          sorted(schedulers), members, clusters, sorted(changesources)])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def load_render_cache(output_dir):
+    try:
+        with open(os.path.join(output_dir, render_cache_filename)) as f:
+            graphs = json.load(f)["graphs"]
+    except (IOError, OSError, ValueError, KeyError):
+        return {}
+    # Older caches listed each graph's files without their hashes; those
+    # graphs are just rendered again.
+    return dict((name, entry) for name, entry in graphs.items() if isinstance(entry.get("files"), dict))
+
+
+def save_render_cache(output_dir, cache):
+    filename = os.path.join(output_dir, render_cache_filename)
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"graphs": cache}, f, indent=2, sort_keys=True)
+    os.rename(filename + ".tmp", filename)
+
+
+def render_graphs(graph_info, output_dir, formats, jobs=1, use_cache=False, force=False,
+                  patterns=(), only=None, timings=None):
+    """Renders every graph in graph_info (as returned by merge_graph_info,
+       optionally with "schedulers", "changesources", "members" and
+       "clusters" for each
+       graph, as render_graph takes) with render_graph, using a pool of `jobs`
+       processes if more than one is requested. A graph that fails to
+       render doesn't stop the others from being rendered; a dict of the
+       failed graph names and their errors is returned instead.
+
+       If use_cache is True, files whose graph's content hash matches the
+       one recorded for them in output_dir aren't rendered again, and the
+       files (in the formats being rendered) of graphs whose roots are all
+       gone are removed. A root is still there if it's in graph_info, or is
+       a cluster of a graph in it, so switching to or from all-in-one
+       graphs keeps the other output. The cache remembers files in every
+       format that's been rendered, not just the current ones. force
+       renders every graph regardless, but still updates the cache. If only
+       is given, the other graphs in graph_info are assumed to be unchanged
+       and aren't looked at.
+
+       If timings (a StageTimings) is given, the rendering of each graph is
+       recorded in it.
+    """
+    if timings is None:
+        timings = StageTimings()
+    with timings.stage("render_graphs") as record:
+        errors = _render_graphs(graph_info, output_dir, formats, jobs, use_cache, force, patterns, only, timings)
+        record["errors"] = len(errors)
+    return errors
+
+
+def _render_graphs(graph_info, output_dir, formats, jobs, use_cache, force, patterns, only, timings):
+    cache = load_render_cache(output_dir) if use_cache else {}
+    # Everything in the cache is carried over, so that the files of formats
+    # that aren't being rendered this time are still known about.
+    new_cache = dict(cache)
+    render_jobs = []
+    pending = {}
+    unchanged = 0
+    for name in sorted(graph_info if only is None else only):
+        nodes = graph_info[name]["nodes"]
+        edges = graph_info[name]["edges"]
+        schedulers = graph_info[name].get("schedulers", set())
+        changesources = graph_info[name].get("changesources", set())
+        members = graph_info[name].get("members", {})
+        clusters = graph_info[name].get("clusters")
+        content_hash = graph_hash(nodes, edges, patterns, schedulers, members, clusters, changesources)
+        files = dict(cache.get(name, {}).get("files", {}))
+        new_cache[name] = {"roots": sorted(clusters) if clusters else [name], "files": files}
+        stale = [fmt for fmt in formats
+                 if force or files.get("%s.%s" % (name, fmt)) != content_hash or
+                 not os.path.exists(os.path.join(output_dir, "%s.%s" % (name, fmt)))]
+        if not stale:
+            unchanged += 1
+            continue
+        pending[name] = (content_hash, stale)
+        render_jobs.append((name, nodes, edges, output_dir, stale, schedulers, members, clusters, changesources))
+
+    if unchanged:
+        log.info("%s: %d graphs unchanged since the last run, not rendering them", output_dir, unchanged)
+
+    if jobs > 1 and len(render_jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(render_jobs)))
+        try:
+            results = pool.map(_render_graph_job, render_jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render_graph_job(job) for job in render_jobs]
+
+    errors = {}
+    for name, error, seconds, rss in results:
+        timings.add("render", seconds, graph=name, peak_rss=rss,
+                    nodes=len(graph_info[name]["nodes"]), edges=len(graph_info[name]["edges"]))
+        content_hash, stale = pending[name]
+        if error:
+            log.error("%s: Failed to render graph:\n%s", name, error)
+            errors[name] = error
+            # Make sure it gets tried again next time.
+            content_hash = None
+        new_cache[name]["files"].update(("%s.%s" % (name, fmt), content_hash) for fmt in stale)
+
+    if use_cache:
+        roots = set(graph_info)
+        for info in graph_info.values():
+            roots.update(info.get("clusters") or ())
+        for name, entry in cache.items():
+            if name in graph_info or not roots.isdisjoint(entry.get("roots", [name])):
+                continue
+            files = new_cache[name]["files"]
+            for fmt in formats:
+                f = "%s.%s" % (name, fmt)
+                if f in files:
+                    del files[f]
+                    if os.path.exists(os.path.join(output_dir, f)):
+                        log.info("%s: Removing stale output %s", name, f)
+                        os.remove(os.path.join(output_dir, f))
+            if not files:
+                del new_cache[name]
+        save_render_cache(output_dir, new_cache)
+
+    return errors
+
+
+def snapshot_schedulers(schedulers):
+    """Extracts the parts of each Scheduler that parse_schedulers looks at
+       into a plain dict, so that they can be saved and graphed later without
+       loading the config again."""
+    records = []
+    for s in schedulers:
+        record = {"name": s.name, "builderNames": list(s.builderNames)}
+        # These are checked in the same order as parse_schedulers does.
+        if getattr(s, "upstream_name", None):
+            record["upstream_name"] = s.upstream_name
+        elif getattr(s, "upstreamBuilders", None):
+            record["upstreamBuilders"] = list(s.upstreamBuilders)
+        elif getattr(s, "trigger", None):
+            record["trigger"] = True
+        records.append(record)
+    return records
+
+
+class SnapshotScheduler:
+    """A Scheduler recreated from a snapshot_schedulers record, with only the
+       attributes that parse_schedulers needs."""
+    def __init__(self, record):
+        self.name = record["name"]
+        self.builderNames = record["builderNames"]
+        if "upstream_name" in record:
+            self.upstream_name = record["upstream_name"]
+        if "upstreamBuilders" in record:
+            self.upstreamBuilders = record["upstreamBuilders"]
+        if record.get("trigger"):
+            self.trigger = True
+
+
+def write_snapshot(filename, masters):
+    """Writes a snapshot of one or more masters' Schedulers to filename.
+       masters is a list of (name, records) tuples, where records is what
+       snapshot_schedulers returns."""
+    snapshot = {
+        "version": 1,
+        "masters": [{"name": name, "schedulers": records} for name, records in masters],
+    }
+    with open(filename, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"), sort_keys=True)
+
+
+def read_snapshot(filename):
+    """Reads a snapshot written by write_snapshot, returning the same list
+       of (name, records) tuples that was written."""
+    with open(filename) as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != 1:
+        raise ValueError("%s: Unsupported snapshot version %s" % (filename, snapshot.get("version")))
+    return [(master["name"], master["schedulers"]) for master in snapshot["masters"]]
+
+
+def diff_snapshots(old_records, new_records):
+    """Compares two snapshots of the same master's Schedulers, as returned
+       by snapshot_schedulers. Returns a tuple of the names of the Schedulers
+       that were added or changed, and the names of the ones that were
+       removed."""
+    old = dict((r["name"], r) for r in old_records)
+    new = dict((r["name"], r) for r in new_records)
+    changed = set(name for name, r in new.items() if old.get(name) != r)
+    removed = set(old) - set(new)
+    return changed, removed
+
+
+def update_root_graphs(graph_info, root_graphs, records, changed, removed,
+                       triggerables={}, sendchanges={}, merge_patterns=None, collapse=False,
+                       changesources={}, index=None):
+    """Incrementally updates graph_info (as returned by parse_schedulers) and
+       root_graphs (as returned by build_root_graphs) in place, after the
+       Schedulers named in changed were added or changed and the ones named
+       in removed were removed (see diff_snapshots). records is the complete,
+       new snapshot of the master's Schedulers. merge_patterns and collapse
+       are passed on to build_root_graphs.
+
+       index is the MergeIndex that graph_info was last merged with, and is
+       kept up to date. Only the roots that the changed Schedulers were
+       merged into before the change, or will be merged into after it, are
+       rebuilt. Without an index, one has to be built from the whole
+       config. Returns a tuple of the names of the root graphs that were
+       rebuilt or added, and the names of the ones that no longer exist.
+    """
+    if index is None:
+        index = MergeIndex(graph_info)
+        for s in root_graphs:
+            if s in graph_info and graph_info[s]["root"]:
+                index.walk(s)
+
+    by_name = dict((r["name"], r) for r in records)
+    # Dependent Schedulers get their upstream builders from their upstream
+    # Scheduler, so they need to be parsed again when it changes.
+    reparse = set(changed)
+    for r in records:
+        if r.get("upstream_name") in changed or r.get("upstream_name") in removed:
+            reparse.add(r["name"])
+    # parse_schedulers needs the upstreams of any Dependents to be able to
+    # parse them, but only the ones that need reparsing are kept.
+    to_parse = set(reparse)
+    for name in reparse:
+        if by_name[name].get("upstream_name") in by_name:
+            to_parse.add(by_name[name]["upstream_name"])
+    parsed = parse_schedulers(
+        [SnapshotScheduler(by_name[name]) for name in sorted(to_parse)],
+        triggerables=triggerables, sendchanges=sendchanges, changesources=changesources,
+    )
+
+    dirty = set()
+    old_upstreams = set()
+    for name in reparse | removed:
+        key = "%s scheduler" % name
+        if key in graph_info:
+            dirty.update(index.roots_of.get(key, ()))
+            old_upstreams.update(index.upstreams(key))
+            index.remove(key)
+    for name in reparse:
+        index.add("%s scheduler" % name, parsed["%s scheduler" % name])
+    # Schedulers may have been added to ChangeSources that had none before...
+    for key, info in parsed.items():
+        if key not in graph_info:
+            index.add(key, info)
+    # ...or ChangeSources may have lost the last Scheduler that listened to
+    # them, in which case parse_schedulers wouldn't have created them.
+    for upstream in old_upstreams:
+        if upstream.endswith(" changesource") and upstream in graph_info and not index.has_waiters(upstream):
+            index.remove(upstream)
+    for key in parsed:
+        if key.endswith(" scheduler") and key[:-len(" scheduler")] not in reparse:
+            continue
+        if graph_info[key]["root"]:
+            dirty.add(key)
+        else:
+            dirty.update(index.upstream_roots(key))
+
+    gone = set()
+    for s in list(dirty):
+        if s not in graph_info or not graph_info[s]["root"]:
+            dirty.discard(s)
+            index.forget(s)
+            if s in root_graphs:
+                del root_graphs[s]
+                gone.add(s)
+    root_graphs.update(build_root_graphs(graph_info, merge_patterns, roots=dirty, collapse=collapse, index=index))
+    return dirty, gone
+
+
+def local_module_files(directory):
+    """Returns the files of every loaded module that lives in directory."""
+    files = set()
+    for module in list(sys.modules.values()):
+        filename = getattr(module, "__file__", None)
+        if not filename:
+            continue
+        filename = os.path.abspath(filename)
+        if filename.endswith((".pyc", ".pyo")):
+            filename = filename[:-1]
+        if filename.startswith(directory + os.sep):
+            files.add(filename)
+    return files
+
+
+def load_config(name, filename):
+    """Loads filename as a module called name, and returns it. Unlike a
+       normal import, the file doesn't need to end in ".py"."""
+    loader = importlib.machinery.SourceFileLoader(name, filename)
+    spec = importlib.util.spec_from_file_location(name, filename, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def load_master(master_cfg, local_files=None):
+    """Loads a master.cfg and returns a snapshot of its Schedulers, as
+       returned by snapshot_schedulers. Loading a config runs it, which can
+       change the current directory, sys.path and other global state, so
+       when loading more than one, each should be loaded in a process of
+       its own.
+
+       If local_files is a set, it's filled in with the config itself and
+       the files of any modules loaded from the config's directory."""
+    curdir = os.path.abspath(os.curdir)
+    try:
+        os.chdir(os.path.dirname(master_cfg))
+        # Put the current directory in sys.path, in case there are imported
+        # files there.
+        sys.path.insert(0, "")
+        cfg = load_config("cfg", master_cfg)
+        if local_files is not None:
+            local_files.add(master_cfg)
+            local_files.update(local_module_files(os.path.dirname(master_cfg)))
+        return snapshot_schedulers(cfg.c["schedulers"])
+    finally:
+        os.chdir(curdir)
+
+
+def _load_master_job(job):
+    try:
+        return load_master(*job), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def load_masters(master_cfgs, jobs=1):
+    """Loads each of master_cfgs with load_master in a pool of `jobs` worker
+       processes, each of which only loads a single config. Returns a list
+       of (records, error) tuples in the same order as master_cfgs, where
+       one of the two is None depending on whether the config loaded."""
+    import multiprocessing
+
+    load_jobs = [(master_cfg,) for master_cfg in master_cfgs]
+    pool = multiprocessing.Pool(max(1, min(jobs, len(load_jobs))), maxtasksperchild=1)
+    try:
+        return pool.map(_load_master_job, load_jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _load_master_files_job(master_cfg):
+    local_files = set()
+    try:
+        return load_master(master_cfg, local_files), local_files, None
+    except Exception:
+        return None, None, traceback.format_exc()
+
+
+def file_mtimes(files):
+    """Returns the modification time of each of files, or None for any that
+       don't exist."""
+    mtimes = {}
+    for f in files:
+        try:
+            mtimes[f] = os.stat(f).st_mtime
+        except OSError:
+            mtimes[f] = None
+    return mtimes
+
+
+def _watch_reload(pool, state, formats, triggerables, sendchanges, changesources, jobs):
+    # Anything that changes while the config is loading will be picked up by
+    # the next check.
+    state["mtimes"] = file_mtimes(state["files"])
+    records, files, error = pool.apply(_load_master_files_job, (state["master_cfg"],))
+    if error:
+        log.error("%s: Failed to load config:\n%s", state["master_cfg"], error)
+        return
+    if files != state["files"]:
+        state["files"] = files
+        state["mtimes"] = file_mtimes(files)
+
+    changed, removed = diff_snapshots(state["records"], records)
+    state["records"] = records
+    if not changed and not removed:
+        log.info("%s: No Schedulers changed", state["master_cfg"])
+        return
+    dirty, gone = update_root_graphs(state["graph_info"], state["root_graphs"], records, changed, removed,
+                                     triggerables, sendchanges, grouped_builder_patterns, state["collapse"],
+                                     changesources, state["index"])
+    errors = render_graphs(state["root_graphs"], state["output_dir"], formats, jobs=jobs,
+                           use_cache=True, patterns=grouped_builder_patterns, only=dirty)
+    log.info("%s: %d Schedulers changed, %d graphs updated, %d removed, %d failed to render",
+             state["master_cfg"], len(changed | removed), len(dirty), len(gone), len(errors))
+
+
+def watch_masters(masters, formats, triggerables={}, sendchanges={}, jobs=1, interval=1.0, debounce=0.5,
+                  collapse=False, changesources={}):
+    """Graphs each of masters, a list of (master_cfg, output_dir) tuples, and
+       then watches their configs (and any modules they import from their
+       own directories) until interrupted. Once a config's files have
+       stopped changing for `debounce` seconds, it's loaded again in a fresh
+       worker process, and only the graphs affected by its changes are
+       rendered again. collapse is passed on to build_root_graphs."""
+    import multiprocessing
+
+    # A worker is only used once, so that each load starts from a clean
+    # slate, but forking one is much cheaper than starting a new process.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        states = []
+        for master_cfg, output_dir in masters:
+            state = {
+                "master_cfg": master_cfg,
+                "output_dir": output_dir,
+                "files": set([master_cfg]),
+                "mtimes": {},
+                "records": [],
+                # The parsed Schedulers are kept around for as long as we're
+                # watching, so they're stored compactly. Only the ones that
+                # change are converted, as they're updated.
+                "graph_info": {},
+                "root_graphs": {},
+                "collapse": collapse,
+            }
+            state["index"] = MergeIndex(state["graph_info"], NameTable())
+            _watch_reload(pool, state, formats, triggerables, sendchanges, changesources, jobs)
+            states.append(state)
+
+        log.info("Watching for changes")
+        while True:
+            time.sleep(interval)
+            for state in states:
+                mtimes = file_mtimes(state["files"])
+                if mtimes == state["mtimes"]:
+                    continue
+                while True:
+                    time.sleep(debounce)
+                    latest = file_mtimes(state["files"])
+                    if latest == mtimes:
+                        break
+                    mtimes = latest
+                log.info("%s: Changed, reloading", state["master_cfg"])
+                _watch_reload(pool, state, formats, triggerables, sendchanges, changesources, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_mapping(filename):
+    """Reads a file that maps Scheduler names to lists of names (eg: of the
+       builders that trigger them), and returns it as a dict. The file is
+       either a single JSON object, or JSON lines: one object per line, in
+       the same format. JSON lines files are read a line at a time, so
+       they can be very large, and the lists for any Scheduler that's in
+       more than one line are merged, without duplicates, in order."""
+    with open(filename) as f:
+        first = f.readline()
+        try:
+            record = json.loads(first) if first.strip() else {}
+        except ValueError:
+            # The first line isn't a whole object, so it must be one
+            # object, formatted over several lines.
+            f.seek(0)
+            return json.load(f)
+        mapping = {}
+        seen = {}
+        line_number = 1
+        while True:
+            if not isinstance(record, dict):
+                raise ValueError("%s:%d: Expected a JSON object" % (filename, line_number))
+            for name, values in record.items():
+                if name not in mapping:
+                    mapping[name] = []
+                    seen[name] = set()
+                for value in values:
+                    if value not in seen[name]:
+                        seen[name].add(value)
+                        mapping[name].append(value)
+            line = f.readline()
+            if not line:
+                return mapping
+            line_number += 1
+            record = json.loads(line) if line.strip() else {}
+
+
+def read_manifest(filename):
+    """Reads a list of master.cfg files from a manifest, one per line. Blank
+       lines and lines starting with # are ignored, and relative paths are
+       relative to the manifest."""
+    master_cfgs = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                master_cfgs.append(os.path.join(os.path.dirname(os.path.abspath(filename)), line))
+    return master_cfgs
+
+
+def unique_names(names):
+    """Makes each of names unique by adding a numeric suffix to repeats."""
+    unique = []
+    for base in names:
+        name = base
+        i = 2
+        while name in unique:
+            name = "%s-%d" % (base, i)
+            i += 1
+        unique.append(name)
+    return unique
+
+
+def master_names(master_cfgs):
+    """Returns a unique name for each of master_cfgs, based on the name of
+       the directory that it's in."""
+    return unique_names([
+        os.path.basename(os.path.dirname(os.path.abspath(master_cfg))) or "master"
+        for master_cfg in master_cfgs
+    ])
 
-    return merged_nodes, merged_edges
 
 def main():
     from argparse import ArgumentParser
-    import pydot
 
     parser = ArgumentParser()
-    parser.add_argument("master_cfg", nargs=1)
-    parser.add_argument("output_dir", nargs=1)
+    parser.add_argument("master_cfg", nargs="*",
+                        help="master.cfg files to graph, or snapshots with --from-snapshot")
+    parser.add_argument("output_dir", nargs=1,
+                        help="Directory to write graphs to, or the snapshot file with --dump-snapshot")
     parser.add_argument("-v", "--verbose", dest="verbose", action="count", default=0)
-    parser.add_argument("-t", "--triggerables", dest="triggerables")
-    parser.add_argument("-s", "--sendchanges", dest="sendchanges")
+    parser.add_argument("-t", "--triggerables", dest="triggerables",
+                        help="JSON or JSON lines file mapping Triggerables to the builders that trigger them")
+    parser.add_argument("-s", "--sendchanges", dest="sendchanges",
+                        help="JSON or JSON lines file mapping Schedulers to the builders that send changes to them")
+    parser.add_argument("-c", "--changesources", dest="changesources",
+                        help="JSON or JSON lines file mapping Schedulers to the ChangeSources that notify them")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1)
+    parser.add_argument("-m", "--manifest", dest="manifest",
+                        help="File listing master.cfg files to graph, one per line")
+    parser.add_argument("--combine", dest="combine", action="store_true", default=False,
+                        help="Graph all of the masters together, instead of in a directory per master")
+    parser.add_argument("--dump-snapshot", dest="dump_snapshot", action="store_true", default=False,
+                        help="Save the Schedulers from the configs to a snapshot instead of graphing them")
+    parser.add_argument("--from-snapshot", dest="from_snapshot", action="store_true", default=False,
+                        help="Graph Schedulers from snapshots instead of loading configs")
+    parser.add_argument("--analyze", dest="analyze", action="store_true", default=False,
+                        help="Check the Schedulers for cycles and unreachable or orphaned nodes instead of "
+                             "graphing them, and write a JSON report to %s in output_dir ('-' for stdout). "
+                             "Exits with an error if there are any cycles or orphaned Schedulers"
+                             % analysis_report_filename)
+    parser.add_argument("-w", "--watch", dest="watch", action="store_true", default=False,
+                        help="Keep running, and update the graphs whenever the configs change")
+    parser.add_argument("--force", dest="force", action="store_true", default=False,
+                        help="Render every graph, even if it hasn't changed since the last run")
+    parser.add_argument("--collapse-equivalent", dest="collapse_equivalent", action="store_true", default=False,
+                        help="Also collapse builders with the same upstreams and downstreams, whatever their names")
+    parser.add_argument("--all-in-one", dest="all_in_one", action="store_true", default=False,
+                        help="Graph every root Scheduler in one graph, with a cluster for each")
+    parser.add_argument("--max-nodes", dest="max_nodes", type=int,
+                        help="With --all-in-one, split the graph into several of at most this many nodes")
+    parser.add_argument("--focus", dest="focus", action="append",
+                        help="Only graph what's upstream and downstream of this builder or Scheduler. "
+                             "May be given more than once")
+    parser.add_argument("--depth", dest="depth", type=int,
+                        help="With --focus, only graph nodes up to this many edges away")
+    parser.add_argument("--timings", dest="timings", action="store_true", default=False,
+                        help="Report how long each stage took to stderr")
+    parser.add_argument("--timings-file", dest="timings_file",
+                        help="Write how long each stage took to this file, as JSON")
+    parser.add_argument("--trace", dest="trace",
+                        help="Write details of every Scheduler and node merge to this file, as JSON lines")
+    parser.add_argument("--profile", dest="profile",
+                        help="Profile the run with cProfile, and save the stats to this file")
     parser.add_argument("--dot", dest="output_dot", action="store_true", default=False)
     parser.add_argument("--svg", dest="output_svg", action="store_true", default=False)
     parser.add_argument("--png", dest="output_png", action="store_true", default=False)
+    parser.add_argument("--json", dest="output_json", action="store_true", default=False)
+    parser.add_argument("--graphml", dest="output_graphml", action="store_true", default=False)
 
     args = parser.parse_args()
-    master_cfg = os.path.abspath(args.master_cfg[0])
+    master_cfgs = [os.path.abspath(m) for m in args.master_cfg]
+    if args.manifest:
+        master_cfgs.extend(read_manifest(args.manifest))
+    if not master_cfgs:
+        parser.error("at least one master.cfg, snapshot or a manifest is required")
     output_dir = args.output_dir[0]
-    output_dot = args.output_dot
-    output_svg = args.output_svg
-    output_png = args.output_png
-    if args.triggerables:
-        triggerables = json.load(open(args.triggerables))
-    else:
-        triggerables = {}
-    if args.sendchanges:
-        sendchanges = json.load(open(args.sendchanges))
-    else:
-        sendchanges = {}
+    formats = []
+    if args.output_dot:
+        formats.append("dot")
+    if args.output_svg:
+        formats.append("svg")
+    if args.output_png:
+        formats.append("png")
+    if args.output_json:
+        formats.append("json")
+    if args.output_graphml:
+        formats.append("graphml")
+    triggerables = read_mapping(args.triggerables) if args.triggerables else {}
+    sendchanges = read_mapping(args.sendchanges) if args.sendchanges else {}
+    changesources = read_mapping(args.changesources) if args.changesources else {}
 
     if args.verbose == 1:
         log.setLevel(logging.INFO)
     elif args.verbose >= 2:
         log.setLevel(logging.DEBUG)
+    if args.trace:
+        enable_trace(args.trace)
+    if args.watch and (args.dump_snapshot or args.from_snapshot or args.combine):
+        parser.error("--watch can't be used with --dump-snapshot, --from-snapshot or --combine")
+    if args.depth is not None and not args.focus:
+        parser.error("--depth can only be used with --focus")
+    if args.analyze and (args.watch or args.dump_snapshot or args.focus or args.all_in_one):
+        parser.error("--analyze can't be used with --watch, --dump-snapshot, --focus or --all-in-one")
+    if args.analyze and output_dir != "-" and os.path.exists(output_dir) and not os.path.isdir(output_dir):
+        parser.error("--analyze writes %s into output_dir, but %s isn't a directory"
+                     % (analysis_report_filename, output_dir))
+    if args.focus and (args.watch or args.dump_snapshot):
+        parser.error("--focus can't be used with --watch or --dump-snapshot")
+    if args.max_nodes is not None and not args.all_in_one:
+        parser.error("--max-nodes can only be used with --all-in-one")
+    if args.all_in_one and (args.watch or args.focus):
+        parser.error("--all-in-one can't be used with --watch or --focus")
 
-    curdir = os.path.abspath(os.curdir)
+    timings = StageTimings()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        os.chdir(os.path.dirname(master_cfg))
-        # Put the current directory in sys.path, in case there are imported
-        # files there.
-        sys.path.insert(0, "")
-        cfg = load_source("cfg", master_cfg)
-
-        graph_info = parse_schedulers(cfg.c["schedulers"], triggerables=triggerables, sendchanges=sendchanges)
-        for name, graph_info in merge_graph_info(graph_info).iteritems():
-            for p in grouped_builder_patterns:
-                graph_info["nodes"], graph_info["edges"] = merge_nodes(graph_info["nodes"], graph_info["edges"], p)
-            graph = pydot.Dot(graph_type="digraph", layout="dot")
-            for node in graph_info["nodes"]:
-                graph.add_node(pydot.Node(node))
-            for edge in graph_info["edges"]:
-                graph.add_edge(pydot.Edge(*edge))
-            if output_dot:
-                graph.write_dot(os.path.join(output_dir, "%s.dot" % name))
-            if output_svg:
-                graph.write_svg(os.path.join(output_dir, "%s.svg" % name))
-            if output_png:
-                graph.write_png(os.path.join(output_dir, "%s.png" % name))
-
+        failed = run(args, master_cfgs, output_dir, formats, triggerables, sendchanges, changesources, timings)
     finally:
-        os.chdir(curdir)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.timings:
+            sys.stderr.write(timings.summary())
+        if args.timings_file:
+            timings.write(args.timings_file)
+
+    if failed:
+        sys.exit(1)
+
+
+def run(args, master_cfgs, output_dir, formats, triggerables, sendchanges, changesources, timings):
+    """Does everything that main() was asked to, once it's parsed the
+       arguments. Returns True if anything failed."""
+    if args.watch:
+        # Watching is pointless if nothing is said about what's happening.
+        if not args.verbose:
+            log.setLevel(logging.INFO)
+        if len(master_cfgs) == 1:
+            masters = [(master_cfgs[0], output_dir)]
+        else:
+            masters = [(m, os.path.join(output_dir, name)) for m, name in zip(master_cfgs, master_names(master_cfgs))]
+        for _, master_output_dir in masters:
+            if not os.path.isdir(master_output_dir):
+                os.makedirs(master_output_dir)
+        try:
+            watch_masters(masters, formats, triggerables, sendchanges, jobs=args.jobs,
+                          collapse=args.collapse_equivalent, changesources=changesources)
+        except KeyboardInterrupt:
+            pass
+        return False
+
+    failed = False
+    loaded = []
+    if args.from_snapshot:
+        with timings.stage("read_snapshot", snapshots=len(master_cfgs)):
+            for snapshot in master_cfgs:
+                for name, records in read_snapshot(snapshot):
+                    loaded.append((name, records))
+    else:
+        with timings.stage("load", masters=len(master_cfgs)):
+            if len(master_cfgs) == 1:
+                # No need to isolate a single config from anything.
+                results = [(load_master(master_cfgs[0]), None)]
+            else:
+                results = load_masters(master_cfgs, jobs=args.jobs)
+        for master_cfg, name, (records, error) in zip(master_cfgs, master_names(master_cfgs), results):
+            if error:
+                log.error("%s: Failed to load config:\n%s", master_cfg, error)
+                failed = True
+                continue
+            loaded.append((name, records))
+
+    if args.dump_snapshot:
+        write_snapshot(output_dir, loaded)
+        return failed
+
+    masters = []
+    names = unique_names([name for name, _ in loaded])
+    for name, (_, records) in zip(names, loaded):
+        with timings.stage("parse_schedulers", master=name, schedulers=len(records)):
+            schedulers = [SnapshotScheduler(record) for record in records]
+            graph_info = parse_schedulers(schedulers, triggerables=triggerables, sendchanges=sendchanges,
+                                          changesources=changesources)
+        if len(loaded) == 1 or args.combine:
+            masters.append((name, output_dir, graph_info))
+        else:
+            masters.append((name, os.path.join(output_dir, name), graph_info))
+    if args.combine:
+        masters = [("combined", output_dir, combine_graph_info(graph_info for _, _, graph_info in masters))]
+
+    if args.analyze:
+        if output_dir == "-":
+            return analyze(masters, output_dir, timings) or failed
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        return analyze(masters, os.path.join(output_dir, analysis_report_filename), timings) or failed
+    if args.focus:
+        return focus(args, masters, formats, timings) or failed
+
+    for name, master_output_dir, graph_info in masters:
+        timings.context["master"] = name
+        if not os.path.isdir(master_output_dir):
+            os.makedirs(master_output_dir)
+        graph_info = build_root_graphs(graph_info, grouped_builder_patterns, timings=timings,
+                                       collapse=args.collapse_equivalent)
+        if args.all_in_one:
+            with timings.stage("all_in_one", roots=len(graph_info)) as record:
+                graph_info = all_in_one_graphs(graph_info, args.max_nodes)
+                record["graphs"] = len(graph_info)
+        errors = render_graphs(graph_info, master_output_dir, formats, jobs=args.jobs,
+                               use_cache=True, force=args.force, patterns=grouped_builder_patterns,
+                               timings=timings)
+        if errors:
+            log.error("%s: Failed to render %d of %d graphs: %s", master_output_dir, len(errors),
+                      len(graph_info), ", ".join(sorted(errors)))
+            failed = True
+
+    return failed
+
+
+# Name of the file in the output directory that --analyze writes its report
+# to.
+analysis_report_filename = "analysis.json"
+
+
+def analyze(masters, report_filename, timings):
+    """Runs analyze_graph_info on each of the masters, logs any problems it
+       finds, and writes all of the results to report_filename as JSON, or
+       to stdout if it's "-". Returns True if there were any cycles or
+       orphaned Schedulers."""
+    failed = False
+    reports = []
+    for name, _, graph_info in masters:
+        with timings.stage("analyze", master=name, schedulers=len(graph_info)):
+            report = analyze_graph_info(graph_info)
+        for cycle in report["cycles"]:
+            log.error("%s: Cycle between %s", name, ", ".join(cycle))
+        for s in report["orphaned_schedulers"]:
+            log.error("%s: %s isn't downstream of any root", name, s)
+        if report["unreachable_builders"]:
+            log.warning("%s: %d builders aren't downstream of any root: %s", name,
+                        len(report["unreachable_builders"]), ", ".join(report["unreachable_builders"]))
+        if report["cycles"] or report["orphaned_schedulers"]:
+            failed = True
+        report["name"] = name
+        reports.append(report)
+
+    if report_filename == "-":
+        json.dump({"masters": reports}, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(report_filename, "w") as f:
+            json.dump({"masters": reports}, f, indent=2, sort_keys=True)
+    return failed
+
+
+def focus(args, masters, formats, timings):
+    """Renders only the neighborhood of the nodes given with --focus, for
+       each of the masters that has them. Returns True if anything failed."""
+    failed = False
+    found = False
+    for name, master_output_dir, graph_info in masters:
+        timings.context["master"] = name
+        with timings.stage("focus", names=len(args.focus), depth=args.depth):
+            try:
+                graph_info = build_focus_graph(graph_info, args.focus, args.depth, grouped_builder_patterns,
+                                               args.collapse_equivalent)
+            except ValueError as e:
+                log.info("%s: %s", name, e)
+                continue
+        found = True
+        if not os.path.isdir(master_output_dir):
+            os.makedirs(master_output_dir)
+        # The cache isn't used, so that the other graphs in the output
+        # directory aren't treated as stale.
+        if render_graphs(graph_info, master_output_dir, formats, timings=timings):
+            failed = True
+    if not found:
+        log.error("None of %s were found in any master", ", ".join(args.focus))
+        failed = True
+    return failed
 
 
 if __name__ == "__main__":
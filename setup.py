@@ -12,8 +12,10 @@ setup(
         'console_scripts': ['buildbot-scheduler-graph = buildbot_scheduler_graph:main'],
     },
     zip_safe=False,
-    install_requires=[
-        "pyparsing==1.5.6",
-        "pydot>=1.0.28",
+    python_requires='>=3.6',
+    classifiers=[
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Topic :: Software Development :: Build Tools',
     ],
 )
@@ -1,9 +1,28 @@
+from io import StringIO
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
+from xml.etree import ElementTree
 
+import buildbot_scheduler_graph
 from buildbot_scheduler_graph import parse_schedulers, merge_graph_info, \
-    merge_nodes
+    merge_nodes, compile_merge_patterns, render_graph, render_graphs, \
+    quote_dot_id, write_json, write_graphml, combine_graph_info, load_masters, \
+    master_names, read_manifest, snapshot_schedulers, SnapshotScheduler, \
+    write_snapshot, read_snapshot, diff_snapshots, update_root_graphs, \
+    build_root_graphs, NameTable, compact_graph_info, expand_graph_info, \
+    StageTimings, enable_trace, trace_log, focus_graph, build_focus_graph, \
+    all_in_one_graphs, write_dot, collapse_equivalent_nodes, read_mapping, \
+    strongly_connected_components, analyze_graph_info, MergeIndex, CompactGraph, \
+    find_dot
 
-class Scheduler(object):
+class Scheduler:
     def __init__(self, name, builderNames):
         self.name = name
         self.builderNames = builderNames
@@ -13,12 +32,12 @@ class Triggerable(Scheduler):
 
 class Dependent(Scheduler):
     def __init__(self, name, builderNames, upstream_name):
-        super(Dependent, self).__init__(name, builderNames)
+        super().__init__(name, builderNames)
         self.upstream_name = upstream_name
 
 class AggregatingScheduler(Scheduler):
     def __init__(self, name, builderNames, upstreamBuilders):
-        super(AggregatingScheduler, self).__init__(name, builderNames)
+        super().__init__(name, builderNames)
         self.upstreamBuilders = upstreamBuilders
 
     def trigger(self):
@@ -37,7 +56,7 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": True,
             }
         }
-        self.assertEquals(parse_schedulers(s), expected)
+        self.assertEqual(parse_schedulers(s), expected)
 
     def testTriggerableScheduler(self):
         s = [
@@ -59,7 +78,7 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             }
         }
-        self.assertEquals(parse_schedulers(s, triggerables=triggerables), expected)
+        self.assertEqual(parse_schedulers(s, triggerables=triggerables), expected)
 
     def testSendchangeUpstream(self):
         s = [
@@ -75,7 +94,36 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             }
         }
-        self.assertEquals(parse_schedulers(s, sendchanges=sendchanges), expected)
+        self.assertEqual(parse_schedulers(s, sendchanges=sendchanges), expected)
+
+    def testChangeSources(self):
+        s = [
+            Scheduler("foo", ("bar",)),
+            Triggerable("trig", ("baz",)),
+        ]
+        changesources = {
+            "foo": ("hg",),
+            # Only plain Schedulers listen to ChangeSources.
+            "trig": ("hg",),
+        }
+        expected = {
+            "foo scheduler": {
+                "nodes": set(("foo scheduler", "bar", "hg changesource")),
+                "edges": set((("foo scheduler", "bar"), ("hg changesource", "foo scheduler"))),
+                "root": False,
+            },
+            "trig scheduler": {
+                "nodes": set(("trig scheduler", "baz")),
+                "edges": set((("trig scheduler", "baz"),)),
+                "root": False,
+            },
+            "hg changesource": {
+                "nodes": set(("hg changesource",)),
+                "edges": set(),
+                "root": True,
+            },
+        }
+        self.assertEqual(parse_schedulers(s, changesources=changesources), expected)
 
     def testDependentScheduler(self):
         s = [
@@ -94,7 +142,7 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             },
         }
-        self.assertEquals(parse_schedulers(s), expected)
+        self.assertEqual(parse_schedulers(s), expected)
 
     def testDependentSchedulerMultipleUpstreamBuilders(self):
         s = [
@@ -113,7 +161,20 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             },
         }
-        self.assertEquals(parse_schedulers(s), expected)
+        self.assertEqual(parse_schedulers(s), expected)
+
+    def testDependentSchedulerMissingUpstream(self):
+        s = [
+            Dependent("foo", ("bar",), upstream_name="base"),
+        ]
+        expected = {
+            "foo scheduler": {
+                "nodes": set(("foo scheduler", "bar")),
+                "edges": set((("foo scheduler", "bar"),)),
+                "root": False,
+            },
+        }
+        self.assertEqual(parse_schedulers(s), expected)
 
     def testAggregatingScheduler(self):
         s = [
@@ -132,7 +193,7 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             },
         }
-        self.assertEquals(parse_schedulers(s), expected)
+        self.assertEqual(parse_schedulers(s), expected)
 
     def testAggergatingSchedulerMultipleUpstreamBuilders(self):
         s = [
@@ -151,7 +212,7 @@ class TestParseSchedulers(unittest.TestCase):
                 "root": False,
             },
         }
-        self.assertEquals(parse_schedulers(s), expected)
+        self.assertEqual(parse_schedulers(s), expected)
 
 
 class TestMergeGraphInfo(unittest.TestCase):
@@ -176,7 +237,7 @@ class TestMergeGraphInfo(unittest.TestCase):
                 "root": True,
             },
         }
-        self.assertEquals(merge_graph_info(graph_info), expected)
+        self.assertEqual(merge_graph_info(graph_info), expected)
 
     def testMultipleUpstreamMerge(self):
         graph_info = {
@@ -198,7 +259,7 @@ class TestMergeGraphInfo(unittest.TestCase):
                 "root": True,
             },
         }
-        self.assertEquals(merge_graph_info(graph_info), expected)
+        self.assertEqual(merge_graph_info(graph_info), expected)
 
     def testMergeWorksRegardlessOfOrder(self):
         from collections import OrderedDict
@@ -220,7 +281,7 @@ class TestMergeGraphInfo(unittest.TestCase):
                 "root": True,
             },
         }
-        self.assertEquals(merge_graph_info(graph_info), expected)
+        self.assertEqual(merge_graph_info(graph_info), expected)
 
     def testMultilevelMerge(self):
         graph_info = {
@@ -250,7 +311,7 @@ class TestMergeGraphInfo(unittest.TestCase):
                 "root": True,
             }
         }
-        self.assertEquals(merge_graph_info(graph_info), expected)
+        self.assertEqual(merge_graph_info(graph_info), expected)
 
     def testDiamondMerge(self):
         graph_info = {
@@ -285,39 +346,943 @@ class TestMergeGraphInfo(unittest.TestCase):
                 "root": True,
             }
         }
-        self.assertEquals(merge_graph_info(graph_info), expected)
+        self.assertEqual(merge_graph_info(graph_info), expected)
+
+    def testRootsSharingBuilderStaySeparate(self):
+        graph_info = {
+            "base1": {
+                "nodes": set(("base1", "basebuilder")),
+                "edges": set((("base1", "basebuilder"),)),
+                "root": True,
+            },
+            "base2": {
+                "nodes": set(("base2", "basebuilder")),
+                "edges": set((("base2", "basebuilder"),)),
+                "root": True,
+            },
+            "foo": {
+                "nodes": set(("foo", "foobuilder", "basebuilder")),
+                "edges": set((("foo", "foobuilder"), ("basebuilder", "foo"))),
+                "root": False,
+            },
+        }
+        expected = {
+            "base1": {
+                "nodes": set(("base1", "basebuilder", "foo", "foobuilder")),
+                "edges": set((("base1", "basebuilder"), ("foo", "foobuilder"), ("basebuilder", "foo"))),
+                "root": True,
+            },
+            "base2": {
+                "nodes": set(("base2", "basebuilder", "foo", "foobuilder")),
+                "edges": set((("base2", "basebuilder"), ("foo", "foobuilder"), ("basebuilder", "foo"))),
+                "root": True,
+            },
+        }
+        self.assertEqual(merge_graph_info(graph_info), expected)
+
+    def testCycleMerge(self):
+        graph_info = {
+            "base": {
+                "nodes": set(("base", "basebuilder")),
+                "edges": set((("base", "basebuilder"),)),
+                "root": True,
+            },
+            "foo": {
+                "nodes": set(("foo", "foobuilder", "basebuilder", "barbuilder")),
+                "edges": set((("foo", "foobuilder"), ("basebuilder", "foo"), ("barbuilder", "foo"))),
+                "root": False,
+            },
+            "bar": {
+                "nodes": set(("bar", "barbuilder", "foobuilder")),
+                "edges": set((("bar", "barbuilder"), ("foobuilder", "bar"))),
+                "root": False,
+            },
+        }
+        expected = {
+            "base": {
+                "nodes": set(("base", "basebuilder", "foo", "foobuilder", "bar", "barbuilder")),
+                "edges": set((("base", "basebuilder"), ("foo", "foobuilder"), ("basebuilder", "foo"),
+                              ("barbuilder", "foo"), ("bar", "barbuilder"), ("foobuilder", "bar"))),
+                "root": True,
+            },
+        }
+        self.assertEqual(merge_graph_info(graph_info), expected)
+
+
+class TestChangeSourceMerge(unittest.TestCase):
+    def testChangeSourceIsRoot(self):
+        graph_info = parse_schedulers([
+            Scheduler("foo", ("foo-build",)),
+            Scheduler("bar", ("bar-build",)),
+            Dependent("test", ("foo-test",), upstream_name="foo"),
+            Scheduler("nightly", ("nightly",)),
+        ], changesources={"foo": ["hg"], "bar": ["hg", "git"]})
+        merged = merge_graph_info(graph_info)
+        self.assertEqual(sorted(merged), ["git changesource", "hg changesource", "nightly scheduler"])
+        self.assertEqual(merged["hg changesource"]["nodes"], set((
+            "hg changesource", "foo scheduler", "foo-build", "bar scheduler", "bar-build",
+            "test scheduler", "foo-test", "git changesource",
+        )))
+        self.assertIn(("hg changesource", "bar scheduler"), merged["hg changesource"]["edges"])
+        self.assertEqual(merged["git changesource"]["nodes"], set((
+            "git changesource", "hg changesource", "bar scheduler", "bar-build",
+        )))
+
+    def testChangeSourceKind(self):
+        graph_info = parse_schedulers([
+            Scheduler("foo", ("foo-build",)),
+        ], changesources={"foo": ["hg"]})
+        root_graphs = build_root_graphs(graph_info, collapse=True)
+        self.assertEqual(root_graphs["hg changesource"]["changesources"], set(("hg changesource",)))
+        self.assertEqual(root_graphs["hg changesource"]["schedulers"], set(("foo scheduler",)))
 
 
 class TestMergeNodes(unittest.TestCase):
     def testNothingToMerge(self):
         nodes = {"base", "foo", "bar"}
         edges = {("base", "foo"), ("base", "bar")}
-        self.assertEquals(merge_nodes(nodes, edges), (nodes, edges))
+        self.assertEqual(merge_nodes(nodes, edges), (nodes, edges))
     def testMergeMultipleDownstream(self):
         nodes = {"base", "foo 1/2", "foo 2/2"}
         edges = {("base", "foo 1/2"), ("base", "foo 2/2")}
         expected = ({"base", "foo"}, {("base", "foo"),})
-        self.assertEquals(merge_nodes(nodes, edges), expected)
+        self.assertEqual(merge_nodes(nodes, edges), expected)
 
     def testMergeMultipleUpstream(self):
         nodes = {"base 1/2", "base 2/2", "foo"}
         edges = {("base 1/2", "foo"), ("base 2/2", "foo")}
         expected = ({"base", "foo"}, {("base", "foo"),})
-        self.assertEquals(merge_nodes(nodes, edges), expected)
+        self.assertEqual(merge_nodes(nodes, edges), expected)
 
     def testUnmergeableDownstreams(self):
         nodes = {"base", "foo 1/2", "foo 2/2"}
         edges = {("base", "foo 1/2")}
-        self.assertEquals(merge_nodes(nodes, edges), (nodes, edges))
+        self.assertEqual(merge_nodes(nodes, edges), (nodes, edges))
 
     def testUnmergeableUpstreams(self):
         nodes = {"base 1/2", "base 2/2", "foo"}
         edges = {("base 1/2", "base 2/2"), ("base 2/2", "foo")}
-        self.assertEquals(merge_nodes(nodes, edges), (nodes, edges))
+        self.assertEqual(merge_nodes(nodes, edges), (nodes, edges))
 
     def testCustomMergePattern(self):
-        p = "(?P<basename>.*) \d+$"
+        p = r"(?P<basename>.*) \d+$"
         nodes = {"base", "foo 1", "foo 2", "foo 3"}
         edges = {("base", "foo 1"), ("base", "foo 2"), ("base", "foo 3")}
         expected = ({"base", "foo"}, {("base", "foo")})
-        self.assertEquals(merge_nodes(nodes, edges, p), expected)
+        self.assertEqual(merge_nodes(nodes, edges, p), expected)
+
+    def testMultiplePatternsApplyInOrder(self):
+        nodes = {"base", "foo 1 1/2", "foo 1 2/2", "foo 2 1/2", "foo 2 2/2"}
+        edges = set(("base", n) for n in nodes if n != "base")
+        expected = ({"base", "foo"}, {("base", "foo")})
+        self.assertEqual(merge_nodes(nodes, edges), expected)
+
+    def testSinglePatternOnlyAppliesItself(self):
+        p = r"(?P<basename>.*)[-_ ]\d+/\d+$"
+        nodes = {"base", "foo 1 1/2", "foo 1 2/2", "foo 2 1/2", "foo 2 2/2"}
+        edges = set(("base", n) for n in nodes if n != "base")
+        expected = ({"base", "foo 1", "foo 2"}, {("base", "foo 1"), ("base", "foo 2")})
+        self.assertEqual(merge_nodes(nodes, edges, p), expected)
+
+    def testMergeDoesNotRenameSubstrings(self):
+        nodes = {"base", "foo 1", "foo 2", "foo 10 upload"}
+        edges = {("base", "foo 1"), ("base", "foo 2"), ("foo 10 upload", "base")}
+        expected = ({"base", "foo", "foo 10 upload"}, {("base", "foo"), ("foo 10 upload", "base")})
+        self.assertEqual(merge_nodes(nodes, edges), expected)
+
+
+class TestCollapseEquivalentNodes(unittest.TestCase):
+    def testCollapsesRegardlessOfName(self):
+        edges = set((
+            ("foo scheduler", "linux opt"), ("foo scheduler", "linux debug"),
+            ("linux opt", "bar scheduler"), ("linux debug", "bar scheduler"),
+        ))
+        nodes = set(("foo scheduler", "linux opt", "linux debug", "bar scheduler", "lonely 1", "lonely 2"))
+        members = {}
+        nodes, edges = collapse_equivalent_nodes(nodes, edges, members)
+        self.assertEqual(nodes, set(("foo scheduler", "linux", "bar scheduler", "lonely 1", "lonely 2")))
+        self.assertEqual(edges, set((("foo scheduler", "linux"), ("linux", "bar scheduler"))))
+        self.assertEqual(members, {"linux": set(("linux opt", "linux debug"))})
+
+    def testPartialNumbers(self):
+        edges = set((("s", "build10"), ("s", "build11"), ("s", "win64 a"), ("s", "win64 b")))
+        nodes, _ = collapse_equivalent_nodes(set(["s", "build10", "build11", "win64 a", "win64 b"]), edges)
+        # All four have the same edges.
+        self.assertEqual(nodes, set(("s", "build10 (+3)")))
+        edges = set((("s", "build10"), ("s", "build11"), ("t", "win64 a"), ("t", "win64 b")))
+        nodes, _ = collapse_equivalent_nodes(set(["s", "t", "build10", "build11", "win64 a", "win64 b"]), edges)
+        self.assertEqual(nodes, set(("s", "t", "build", "win64")))
+
+    def testNameCollisions(self):
+        edges = set((("s", "a"), ("s", "ab"), ("s", "ac"), ("t", "a 1"), ("t", "a 2")))
+        nodes, _ = collapse_equivalent_nodes(set(["s", "t", "a", "ab", "ac", "a 1", "a 2"]), edges)
+        self.assertEqual(nodes, set(("s", "t", "a", "a 1 (+1)")))
+
+    def testComposesWithMergeNodes(self):
+        graph_info = build_root_graphs(parse_schedulers([
+            Scheduler("base", ("linux 1/2", "linux 2/2", "mac", "base")),
+        ]), collapse=True)
+        info = graph_info["base scheduler"]
+        # The Scheduler named after its builder isn't collapsed with it.
+        self.assertEqual(info["nodes"], set(("base scheduler", "base (+2)")))
+        self.assertEqual(info["members"], {"base (+2)": set(("linux 1/2", "linux 2/2", "mac", "base"))})
+        self.assertEqual(info["schedulers"], set(("base scheduler",)))
+
+
+class TestCompileMergePatterns(unittest.TestCase):
+    def testCompiledOnce(self):
+        patterns = [r"(?P<basename>.*) \d+$", r"(?P<basename>.*)-\d+$"]
+        self.assertIs(compile_merge_patterns(patterns), compile_merge_patterns(list(patterns)))
+
+    def testPrefilterMatchesAnyPattern(self):
+        _, prefilter = compile_merge_patterns([r"(?P<basename>.*) \d+$", r"(?P<basename>.*)-\d+$"])
+        self.assertTrue(prefilter.match("foo 1"))
+        self.assertTrue(prefilter.match("foo-1"))
+        self.assertFalse(prefilter.match("foo"))
+
+
+class TestRenderGraphs(unittest.TestCase):
+    def testFailuresDontStopOtherGraphs(self):
+        graph_info = {
+            "bad": {"nodes": set(("bad",)), "edges": set(), "root": True},
+            "good": {"nodes": set(("good",)), "edges": set(), "root": True},
+        }
+        rendered = []
+        def render_graph(name, nodes, edges, output_dir, formats, *args):
+            if name == "bad":
+                raise Exception("broken")
+            rendered.append(name)
+
+        with mock.patch.object(buildbot_scheduler_graph, "render_graph", render_graph):
+            errors = render_graphs(graph_info, "out", ["svg"])
+        self.assertEqual(rendered, ["good"])
+        self.assertEqual(list(errors), ["bad"])
+        self.assertIn("broken", errors["bad"])
+
+    def testCacheSkipsUnchangedGraphs(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        graph_info = {
+            "foo": {"nodes": set(("foo", "bar")), "edges": set((("foo", "bar"),)), "root": True},
+            "baz": {"nodes": set(("baz",)), "edges": set(), "root": True},
+        }
+        rendered = []
+        def render_graph(name, nodes, edges, output_dir, formats, *args):
+            rendered.append(name)
+            for fmt in formats:
+                open(os.path.join(output_dir, "%s.%s" % (name, fmt)), "w").close()
+
+        with mock.patch.object(buildbot_scheduler_graph, "render_graph", render_graph):
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True)
+            self.assertEqual(rendered, ["baz", "foo"])
+
+            del rendered[:]
+            graph_info["foo"]["nodes"].add("new")
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True)
+            self.assertEqual(rendered, ["foo"])
+
+            del rendered[:]
+            del graph_info["baz"]
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True)
+            self.assertEqual(rendered, [])
+            self.assertFalse(os.path.exists(os.path.join(output_dir, "baz.svg")))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "foo.svg")))
+
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True, force=True)
+            self.assertEqual(rendered, ["foo"])
+
+            del rendered[:]
+            graph_info["baz"] = {"nodes": set(("baz",)), "edges": set(), "root": True}
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True, only=set(["baz"]))
+            self.assertEqual(rendered, ["baz"])
+            render_graphs(graph_info, output_dir, ["svg"], use_cache=True)
+            self.assertEqual(rendered, ["baz"])
+
+    def testCacheKeepsOtherFormatsAndGraphs(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        graph_info = {
+            "foo": {"nodes": set(("foo", "bar")), "edges": set((("foo", "bar"),)), "root": True},
+            "baz": {"nodes": set(("baz",)), "edges": set(), "root": True},
+        }
+        rendered = []
+        def render_graph(name, nodes, edges, output_dir, formats, *args):
+            rendered.append((name, list(formats)))
+            for fmt in formats:
+                open(os.path.join(output_dir, "%s.%s" % (name, fmt)), "w").close()
+        def outputs():
+            return sorted(f for f in os.listdir(output_dir) if not f.startswith("."))
+
+        with mock.patch.object(buildbot_scheduler_graph, "render_graph", render_graph):
+            render_graphs(graph_info, output_dir, ["dot", "json"], use_cache=True)
+            render_graphs(graph_info, output_dir, ["graphml"], use_cache=True)
+            self.assertEqual(outputs(), ["baz.dot", "baz.graphml", "baz.json", "foo.dot", "foo.graphml", "foo.json"])
+
+            # Only the formats that aren't up to date are rendered.
+            del rendered[:]
+            render_graphs(graph_info, output_dir, ["dot", "svg"], use_cache=True)
+            self.assertEqual(rendered, [("baz", ["svg"]), ("foo", ["svg"])])
+
+            # All-in-one graphs don't replace the per-root ones...
+            render_graphs(all_in_one_graphs(graph_info), output_dir, ["dot"], use_cache=True)
+            self.assertIn("all-in-one.dot", outputs())
+            self.assertIn("foo.dot", outputs())
+
+            # ...and only files in the formats being rendered are removed
+            # once a root is gone.
+            del graph_info["baz"]
+            render_graphs(graph_info, output_dir, ["dot"], use_cache=True)
+            self.assertEqual(outputs(), ["all-in-one.dot", "baz.graphml", "baz.json", "baz.svg",
+                                         "foo.dot", "foo.graphml", "foo.json", "foo.svg"])
+            render_graphs(graph_info, output_dir, ["graphml", "json", "svg"], use_cache=True)
+            self.assertEqual(outputs(), ["all-in-one.dot", "foo.dot", "foo.graphml", "foo.json", "foo.svg"])
+
+
+class TestRenderGraph(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def testDotWrittenWithoutGraphviz(self):
+        with mock.patch("subprocess.Popen") as popen:
+            render_graph("foo", set(("foo", "bar")), set((("foo", "bar"),)), self.output_dir, ["dot"])
+        self.assertFalse(popen.called)
+        with open(os.path.join(self.output_dir, "foo.dot")) as f:
+            self.assertEqual(f.read(), 'digraph G {\nlayout=dot;\n"bar";\n"foo";\n"foo" -> "bar";\n}\n')
+
+    def testAllFormatsFromOneLayout(self):
+        with mock.patch("subprocess.Popen") as popen, \
+                mock.patch.object(buildbot_scheduler_graph, "find_dot", return_value="/opt/graphviz/dot"):
+            popen.return_value.returncode = 0
+            render_graph("foo", set(("foo", "bar")), set((("foo", "bar"),)), self.output_dir, ["dot", "svg", "png"])
+        self.assertEqual(popen.call_count, 1)
+        self.assertEqual(popen.call_args[0][0], [
+            "/opt/graphviz/dot",
+            "-Tsvg", "-o%s" % os.path.join(self.output_dir, "foo.svg"),
+            "-Tpng", "-o%s" % os.path.join(self.output_dir, "foo.png"),
+        ])
+
+
+class TestFindDot(unittest.TestCase):
+    def setUp(self):
+        find_dot.cache_clear()
+        self.addCleanup(find_dot.cache_clear)
+
+    def testEnvironmentOverride(self):
+        with mock.patch.dict(os.environ, {"GRAPHVIZ_DOT": "/opt/graphviz/dot"}):
+            self.assertEqual(find_dot(), "/opt/graphviz/dot")
+
+    def testLookedUpOnce(self):
+        with mock.patch.dict(os.environ, {"GRAPHVIZ_DOT": ""}), \
+                mock.patch("shutil.which", return_value="/usr/local/bin/dot") as which:
+            self.assertEqual(find_dot(), "/usr/local/bin/dot")
+            self.assertEqual(find_dot(), "/usr/local/bin/dot")
+        self.assertEqual(which.call_count, 1)
+
+    def testNotFound(self):
+        with mock.patch.dict(os.environ, {"GRAPHVIZ_DOT": ""}), mock.patch("shutil.which", return_value=None):
+            self.assertEqual(find_dot(), "dot")
+
+
+class TestWriteDot(unittest.TestCase):
+    def testClusters(self):
+        f = StringIO()
+        write_dot(f, set(("a scheduler", "b scheduler", "shared")),
+                  set((("a scheduler", "shared"), ("b scheduler", "shared"))),
+                  clusters={"b scheduler": set(("b scheduler",)), "a scheduler": set(("a scheduler",))})
+        self.assertEqual(f.getvalue(), "\n".join((
+            'digraph G {',
+            'layout=dot;',
+            'subgraph "cluster_0" {',
+            'label="a scheduler";',
+            '"a scheduler";',
+            '}',
+            'subgraph "cluster_1" {',
+            'label="b scheduler";',
+            '"b scheduler";',
+            '}',
+            '"shared";',
+            '"a scheduler" -> "shared";',
+            '"b scheduler" -> "shared";',
+            '}',
+        )) + "\n")
+
+
+class TestWriteJson(unittest.TestCase):
+    def testNodeInfo(self):
+        f = StringIO()
+        write_json(f, "foo scheduler", set(("foo scheduler", "bar")), set((("foo scheduler", "bar"),)),
+                   schedulers=set(("foo scheduler",)), members={"bar": set(("bar 2/2", "bar 1/2"))})
+        self.assertEqual(json.loads(f.getvalue()), {
+            "name": "foo scheduler",
+            "nodes": [
+                {"name": "bar", "kind": "builder", "root": False, "members": ["bar 1/2", "bar 2/2"]},
+                {"name": "foo scheduler", "kind": "scheduler", "root": True, "members": []},
+            ],
+            "edges": [["foo scheduler", "bar"]],
+        })
+
+    def testChangeSourceKind(self):
+        f = StringIO()
+        write_json(f, "hg changesource", set(("hg changesource", "foo scheduler")),
+                   set((("hg changesource", "foo scheduler"),)),
+                   schedulers=set(("foo scheduler",)), changesources=set(("hg changesource",)))
+        kinds = dict((n["name"], n["kind"]) for n in json.loads(f.getvalue())["nodes"])
+        self.assertEqual(kinds, {"foo scheduler": "scheduler", "hg changesource": "changesource"})
+
+
+class TestWriteGraphml(unittest.TestCase):
+    def testNodeInfo(self):
+        f = StringIO()
+        write_graphml(f, "foo scheduler", set(("foo scheduler", "bar & baz")), set((("foo scheduler", "bar & baz"),)),
+                      schedulers=set(("foo scheduler",)))
+        root = ElementTree.fromstring(f.getvalue())
+        ns = "{http://graphml.graphdrawing.org/xmlns}"
+        nodes = dict((n.get("id"), dict((d.get("key"), d.text) for d in n)) for n in root.iter(ns + "node"))
+        self.assertEqual(nodes, {
+            "bar & baz": {"kind": "builder", "root": "false"},
+            "foo scheduler": {"kind": "scheduler", "root": "true"},
+        })
+        edges = [(e.get("source"), e.get("target")) for e in root.iter(ns + "edge")]
+        self.assertEqual(edges, [("foo scheduler", "bar & baz")])
+
+
+class TestQuoteDotId(unittest.TestCase):
+    def testPlain(self):
+        self.assertEqual(quote_dot_id("foo bar"), '"foo bar"')
+
+    def testQuotesAndBackslashes(self):
+        self.assertEqual(quote_dot_id('foo "bar" \\ baz'), '"foo \\"bar\\" \\\\ baz"')
+
+
+class TestCombineGraphInfo(unittest.TestCase):
+    def testSharedScheduler(self):
+        graph_info1 = {
+            "foo": {"nodes": set(("foo", "bar")), "edges": set((("foo", "bar"),)), "root": True},
+        }
+        graph_info2 = {
+            "foo": {"nodes": set(("foo", "baz", "up")), "edges": set((("foo", "baz"), ("up", "foo"))), "root": False},
+            "other": {"nodes": set(("other",)), "edges": set(), "root": True},
+        }
+        expected = {
+            "foo": {
+                "nodes": set(("foo", "bar", "baz", "up")),
+                "edges": set((("foo", "bar"), ("foo", "baz"), ("up", "foo"))),
+                "root": False,
+            },
+            "other": {"nodes": set(("other",)), "edges": set(), "root": True},
+        }
+        self.assertEqual(combine_graph_info([graph_info1, graph_info2]), expected)
+
+
+class TestLoadMasters(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def writeConfig(self, master, contents):
+        os.mkdir(os.path.join(self.tmpdir, master))
+        filename = os.path.join(self.tmpdir, master, "master.cfg")
+        with open(filename, "w") as f:
+            f.write(contents)
+        return filename
+
+    def testLoadsEachConfig(self):
+        config = """
+class Scheduler:
+    def __init__(self, name, builderNames):
+        self.name = name
+        self.builderNames = builderNames
+c = {"schedulers": [Scheduler(%r, ["builder"])]}
+"""
+        master_cfgs = [
+            self.writeConfig("master1", config % "foo"),
+            self.writeConfig("master2", config % "bar"),
+            self.writeConfig("master3", "raise Exception('broken config')"),
+        ]
+        results = load_masters(master_cfgs, jobs=2)
+        self.assertEqual(results[0], ([{"name": "foo", "builderNames": ["builder"]}], None))
+        self.assertEqual(results[1], ([{"name": "bar", "builderNames": ["builder"]}], None))
+        self.assertEqual(results[2][0], None)
+        self.assertIn("broken config", results[2][1])
+
+    def testLocalFiles(self):
+        master_cfg = self.writeConfig("master", """
+from helpers import builders
+class Scheduler:
+    def __init__(self, name, builderNames):
+        self.name = name
+        self.builderNames = builderNames
+c = {"schedulers": [Scheduler("foo", builders)]}
+""")
+        with open(os.path.join(self.tmpdir, "master", "helpers.py"), "w") as f:
+            f.write("builders = ['builder']\n")
+        # Loading a config pollutes the process that loads it.
+        pool = multiprocessing.Pool(1)
+        try:
+            records, local_files, error = pool.apply(buildbot_scheduler_graph._load_master_files_job, (master_cfg,))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(error, None)
+        self.assertEqual(records, [{"name": "foo", "builderNames": ["builder"]}])
+        self.assertEqual(local_files, set([master_cfg, os.path.join(self.tmpdir, "master", "helpers.py")]))
+
+    def testMasterNames(self):
+        self.assertEqual(master_names(["/a/master1/master.cfg", "/b/master1/master.cfg", "/a/master2/master.cfg"]),
+                         ["master1", "master1-2", "master2"])
+
+    def testReadManifest(self):
+        manifest = os.path.join(self.tmpdir, "manifest")
+        with open(manifest, "w") as f:
+            f.write("# masters\nmaster1/master.cfg\n\n/abs/master.cfg\n")
+        self.assertEqual(read_manifest(manifest), [
+            os.path.join(self.tmpdir, "master1/master.cfg"),
+            "/abs/master.cfg",
+        ])
+
+
+class TestSnapshot(unittest.TestCase):
+    def testParsesLikeOriginal(self):
+        s = [
+            Scheduler("base", ("upstream1", "upstream2")),
+            Dependent("dep", ("depbuilder",), upstream_name="base"),
+            AggregatingScheduler("agg", ("aggbuilder",), upstreamBuilders=("upstream1",)),
+            Triggerable("trig", ("trigbuilder",)),
+            Scheduler("sendchange", ("sendchangebuilder",)),
+        ]
+        triggerables = {"trig": ("depbuilder",)}
+        sendchanges = {"sendchange": ("aggbuilder",)}
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "snapshot.json")
+        write_snapshot(filename, [("master", snapshot_schedulers(s))])
+        ((name, records),) = read_snapshot(filename)
+        self.assertEqual(name, "master")
+        self.assertEqual(
+            parse_schedulers([SnapshotScheduler(r) for r in records], triggerables, sendchanges),
+            parse_schedulers(s, triggerables, sendchanges),
+        )
+
+
+class TestUpdateRootGraphs(unittest.TestCase):
+    def setUp(self):
+        self.records = snapshot_schedulers([
+            Scheduler("base", ("basebuilder 1/2", "basebuilder 2/2")),
+            Dependent("dep", ("depbuilder",), upstream_name="base"),
+            AggregatingScheduler("agg", ("aggbuilder",), upstreamBuilders=("depbuilder",)),
+            Scheduler("other", ("otherbuilder",)),
+            Dependent("otherdep", ("otherdepbuilder",), upstream_name="other"),
+        ])
+
+    def update(self, new_records, changesources={}):
+        graph_info = parse_schedulers([SnapshotScheduler(r) for r in self.records], changesources=changesources)
+        root_graphs = build_root_graphs(graph_info)
+        changed, removed = diff_snapshots(self.records, new_records)
+        result = update_root_graphs(graph_info, root_graphs, new_records, changed, removed,
+                                    changesources=changesources)
+        expected_graph_info = parse_schedulers([SnapshotScheduler(r) for r in new_records],
+                                               changesources=changesources)
+        self.assertEqual(graph_info, expected_graph_info)
+        self.assertEqual(root_graphs, build_root_graphs(expected_graph_info))
+        return result
+
+    def testChangedBuilders(self):
+        new_records = [dict(r) for r in self.records]
+        new_records[1]["builderNames"] = ["depbuilder", "newbuilder"]
+        self.assertEqual(self.update(new_records), (set(["base scheduler"]), set()))
+
+    def testChangedUpstream(self):
+        new_records = [dict(r) for r in self.records]
+        new_records[0]["builderNames"] = ["basebuilder"]
+        self.assertEqual(self.update(new_records), (set(["base scheduler"]), set()))
+
+    def testMovedBetweenRoots(self):
+        new_records = [dict(r) for r in self.records]
+        new_records[1]["upstream_name"] = "other"
+        self.assertEqual(self.update(new_records), (set(["base scheduler", "other scheduler"]), set()))
+
+    def testAddedAndRemovedRoots(self):
+        new_records = [dict(r) for r in self.records if r["name"] != "other"]
+        new_records.append({"name": "new", "builderNames": ["newbuilder"]})
+        self.assertEqual(self.update(new_records), (set(["new scheduler"]), set(["other scheduler"])))
+
+    def testNothingChanged(self):
+        self.assertEqual(self.update(self.records), (set(), set()))
+
+    def testChangeSourceAdded(self):
+        new_records = [dict(r) for r in self.records]
+        new_records.append({"name": "new", "builderNames": ["newbuilder"]})
+        self.assertEqual(self.update(new_records, {"new": ["hg"]}), (set(["hg changesource"]), set()))
+
+    def testChangeSourceRemoved(self):
+        new_records = [dict(r) for r in self.records if r["name"] != "other"]
+        self.assertEqual(self.update(new_records, {"other": ["hg"]}),
+                         (set(), set(["hg changesource"])))
+
+    def testChangeSourceNoLongerListenedTo(self):
+        new_records = [dict(r) for r in self.records]
+        new_records[3]["upstream_name"] = "base"
+        self.assertEqual(self.update(new_records, {"other": ["hg"], "base": ["git"]}),
+                         (set(["git changesource"]), set(["hg changesource"])))
+
+    def testCompactStorage(self):
+        graph_info = {}
+        index = MergeIndex(graph_info, NameTable())
+        root_graphs = {}
+        update_root_graphs(graph_info, root_graphs, self.records,
+                           set(r["name"] for r in self.records), set(), index=index)
+        new_records = [dict(r) for r in self.records]
+        new_records[1]["upstream_name"] = "other"
+        changed, removed = diff_snapshots(self.records, new_records)
+        update_root_graphs(graph_info, root_graphs, new_records, changed, removed, index=index)
+        for graph in graph_info.values():
+            self.assertIsInstance(graph, CompactGraph)
+        expected_graph_info = parse_schedulers([SnapshotScheduler(r) for r in new_records])
+        self.assertEqual(expand_graph_info(graph_info), expected_graph_info)
+        self.assertEqual(root_graphs, build_root_graphs(expected_graph_info))
+
+    def testKeepsIndexBetweenUpdates(self):
+        graph_info = parse_schedulers([SnapshotScheduler(r) for r in self.records])
+        index = MergeIndex(graph_info)
+        root_graphs = build_root_graphs(graph_info, index=index)
+        moved = [dict(r) for r in self.records]
+        moved[1]["upstream_name"] = "other"
+        without_base = [dict(r) for r in moved if r["name"] != "base"]
+        old_records = self.records
+        for new_records in (moved, without_base, self.records):
+            changed, removed = diff_snapshots(old_records, new_records)
+            update_root_graphs(graph_info, root_graphs, new_records, changed, removed, index=index)
+            expected_graph_info = parse_schedulers([SnapshotScheduler(r) for r in new_records])
+            self.assertEqual(graph_info, expected_graph_info)
+            self.assertEqual(root_graphs, build_root_graphs(expected_graph_info))
+            old_records = new_records
+
+
+class TestCompactGraphInfo(unittest.TestCase):
+    def testRoundTrip(self):
+        s = [
+            Scheduler("base", ("upstream1", "upstream2")),
+            Dependent("foo", ("bar",), upstream_name="base"),
+        ]
+        graph_info = parse_schedulers(s)
+        self.assertEqual(expand_graph_info(compact_graph_info(graph_info)), graph_info)
+
+    def testSharedNames(self):
+        s = [
+            Scheduler("base", ("upstream1", "upstream2")),
+            Dependent("foo", ("bar",), upstream_name="base"),
+        ]
+        table = NameTable()
+        compact = compact_graph_info(parse_schedulers(s), table)
+        self.assertEqual(sorted(table.names), ["bar", "base scheduler", "foo scheduler", "upstream1", "upstream2"])
+        upstream1 = table.intern("upstream1")
+        self.assertIn(upstream1, compact["base scheduler"].node_ids())
+        self.assertIn(upstream1, compact["foo scheduler"].node_ids())
+        self.assertEqual(compact["foo scheduler"].edge_ids(), set((
+            (table.intern("foo scheduler"), table.intern("bar")),
+            (upstream1, table.intern("foo scheduler")),
+            (table.intern("upstream2"), table.intern("foo scheduler")),
+        )))
+
+    def testMergedWithoutExpanding(self):
+        graph_info = parse_schedulers([
+            Scheduler("base", ("build 1/2", "build 2/2")),
+            Dependent("test", ("test",), upstream_name="base"),
+            AggregatingScheduler("agg", ("agg",), upstreamBuilders=("build 1/2", "test")),
+            Scheduler("other", ("other",)),
+        ], changesources={"base": ["hg"]})
+        compact = compact_graph_info(graph_info)
+        expanded = []
+        def getitem(graph, key):
+            if key != "root":
+                expanded.append(key)
+            return original(graph, key)
+        original = CompactGraph.__getitem__
+        with mock.patch.object(CompactGraph, "__getitem__", getitem):
+            index = MergeIndex(compact)
+            merged = merge_graph_info(compact, index=index)
+            self.assertEqual(index.upstream_roots("test scheduler"), set(["hg changesource"]))
+            self.assertEqual(index.upstreams("test scheduler"), set(["build 1/2", "build 2/2"]))
+        self.assertEqual(expanded, [])
+        self.assertEqual(merged, merge_graph_info(graph_info))
+
+
+class TestStageTimings(unittest.TestCase):
+    def testRecordsStages(self):
+        timings = StageTimings()
+        graph_info = parse_schedulers([
+            Scheduler("base", ("upstream 1/2", "upstream 2/2")),
+            Dependent("foo", ("bar",), upstream_name="base"),
+        ])
+        timings.context["master"] = "master"
+        build_root_graphs(graph_info, timings=timings)
+        self.assertEqual([r["stage"] for r in timings.records], ["merge_graph_info", "merge_nodes"])
+        merge_nodes_record = timings.records[1]
+        self.assertEqual(merge_nodes_record["master"], "master")
+        self.assertEqual(merge_nodes_record["graph"], "base scheduler")
+        self.assertEqual(merge_nodes_record["nodes"], 5)
+        self.assertEqual(merge_nodes_record["merged_nodes"], 4)
+        self.assertIn("merge_nodes", timings.summary())
+
+    def testTimingsOptionTakesNoValue(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot = os.path.join(tmpdir, "snapshot.json")
+        write_snapshot(snapshot, [("master", [{"name": "foo", "builderNames": ["bar"]}])])
+        with open(snapshot) as f:
+            contents = f.read()
+        output_dir = os.path.join(tmpdir, "out")
+        timings_file = os.path.join(tmpdir, "timings.json")
+        argv = ["buildbot-scheduler-graph", "--timings", snapshot, output_dir, "--from-snapshot", "--dot",
+                "--timings-file", timings_file]
+        with mock.patch("sys.argv", argv), mock.patch("sys.stderr", StringIO()) as stderr:
+            buildbot_scheduler_graph.main()
+        with open(snapshot) as f:
+            self.assertEqual(f.read(), contents)
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "foo scheduler.dot")))
+        self.assertIn("parse_schedulers", stderr.getvalue())
+        with open(timings_file) as f:
+            self.assertIn("parse_schedulers", [r["stage"] for r in json.load(f)["stages"]])
+
+
+class TestFocusGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph_info = parse_schedulers([
+            Scheduler("base", ("build 1/2", "build 2/2")),
+            Dependent("test", ("test 1/2", "test 2/2"), upstream_name="base"),
+            AggregatingScheduler("agg", ("agg",), upstreamBuilders=("test 1/2", "test 2/2")),
+            Scheduler("other", ("other",)),
+        ])
+
+    def testUpstreamAndDownstream(self):
+        nodes, edges = focus_graph(self.graph_info, ["test 1/2"])
+        self.assertEqual(nodes, set((
+            "base scheduler", "build 1/2", "build 2/2", "test scheduler", "test 1/2",
+            "agg scheduler", "agg",
+        )))
+        self.assertIn(("test scheduler", "test 1/2"), edges)
+        self.assertIn(("test 1/2", "agg scheduler"), edges)
+        # Siblings are only included if they're on a path to or from the node.
+        self.assertNotIn(("test scheduler", "test 2/2"), edges)
+        self.assertNotIn("other", nodes)
+
+    def testDepth(self):
+        nodes, edges = focus_graph(self.graph_info, ["test 1/2"], depth=1)
+        self.assertEqual(nodes, set(("test scheduler", "test 1/2", "agg scheduler")))
+        self.assertEqual(edges, set((("test scheduler", "test 1/2"), ("test 1/2", "agg scheduler"))))
+
+    def testSchedulerName(self):
+        nodes, _ = focus_graph(self.graph_info, ["other"], depth=0)
+        self.assertEqual(nodes, set(("other",)))
+        nodes, _ = focus_graph(self.graph_info, ["agg"], depth=1)
+        self.assertEqual(nodes, set(("agg", "agg scheduler")))
+        nodes, _ = focus_graph(self.graph_info, ["base"], depth=1)
+        self.assertEqual(nodes, set(("base scheduler", "build 1/2", "build 2/2")))
+
+    def testUnknown(self):
+        self.assertRaises(ValueError, focus_graph, self.graph_info, ["base", "missing"])
+
+    def testBuildFocusGraph(self):
+        graph_info = build_focus_graph(self.graph_info, ["base"], depth=1)
+        self.assertEqual(list(graph_info), ["focus base"])
+        info = graph_info["focus base"]
+        self.assertEqual(info["nodes"], set(("base scheduler", "build")))
+        self.assertEqual(info["members"], {"build": set(("build 1/2", "build 2/2"))})
+        self.assertEqual(info["schedulers"], set(("base scheduler",)))
+
+
+class TestAllInOneGraphs(unittest.TestCase):
+    def setUp(self):
+        self.root_graphs = build_root_graphs(parse_schedulers([
+            Scheduler("a", ("a 1/2", "a 2/2", "shared")),
+            Scheduler("b", ("b", "shared")),
+            Scheduler("c", ("c",)),
+        ]))
+
+    def testOneGraph(self):
+        graphs = all_in_one_graphs(self.root_graphs)
+        self.assertEqual(list(graphs), ["all-in-one"])
+        info = graphs["all-in-one"]
+        self.assertEqual(info["nodes"], set(("a scheduler", "a", "b scheduler", "b", "c scheduler", "c", "shared")))
+        self.assertEqual(info["clusters"], {
+            "a scheduler": set(("a scheduler", "a")),
+            "b scheduler": set(("b scheduler", "b")),
+            "c scheduler": set(("c scheduler", "c")),
+        })
+        self.assertEqual(info["members"], {"a": set(("a 1/2", "a 2/2"))})
+        self.assertEqual(info["schedulers"], set(("a scheduler", "b scheduler", "c scheduler")))
+
+    def testMaxNodes(self):
+        graphs = all_in_one_graphs(self.root_graphs, max_nodes=5)
+        self.assertEqual(sorted(graphs), ["all-in-one 1", "all-in-one 2"])
+        # Roots that share nodes stay together.
+        self.assertEqual(sorted(graphs["all-in-one 1"]["clusters"]), ["a scheduler", "b scheduler"])
+        self.assertEqual(sorted(graphs["all-in-one 2"]["clusters"]), ["c scheduler"])
+
+    def testMaxNodesSplitsComponents(self):
+        graphs = all_in_one_graphs(self.root_graphs, max_nodes=3)
+        self.assertEqual(len(graphs), 3)
+        for info in graphs.values():
+            self.assertEqual(len(info["clusters"]), 1)
+            for cluster in info["clusters"].values():
+                self.assertEqual(cluster, info["nodes"])
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.trace_file = os.path.join(self.tmpdir, "trace.jsonl")
+
+    def tearDown(self):
+        for handler in trace_log.handlers[:]:
+            trace_log.removeHandler(handler)
+            handler.close()
+        trace_log.setLevel(buildbot_scheduler_graph.logging.WARNING)
+        shutil.rmtree(self.tmpdir)
+
+    def readTrace(self):
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    def testDisabledByDefault(self):
+        with mock.patch("buildbot_scheduler_graph.trace") as trace:
+            graph_info = parse_schedulers([
+                Scheduler("base", ("build 1/2", "build 2/2")),
+                Dependent("foo", ("test",), upstream_name="base"),
+            ])
+            build_root_graphs(graph_info)
+        self.assertEqual(trace.call_count, 0)
+
+    def testEvents(self):
+        enable_trace(self.trace_file)
+        graph_info = parse_schedulers([
+            Scheduler("base", ("build 1/2", "build 2/2")),
+            Dependent("foo", ("test",), upstream_name="base"),
+        ])
+        build_root_graphs(graph_info)
+        events = self.readTrace()
+        self.assertEqual([e["event"] for e in events], ["scheduler", "scheduler", "merge_graph", "merge_group"])
+        self.assertEqual(events[1]["kind"], "Dependent")
+        self.assertEqual(events[1]["upstream_builders"], ["build 1/2", "build 2/2"])
+        self.assertEqual(events[2]["schedulers"], ["base scheduler", "foo scheduler"])
+        self.assertEqual(events[3]["basename"], "build")
+        self.assertTrue(events[3]["mergeable"])
+
+
+class TestStartup(unittest.TestCase):
+    def testNoHeavyImports(self):
+        # Run in a fresh interpreter, since this one has imported everything.
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, buildbot_scheduler_graph; "
+            "print(' '.join(sorted(m for m in ('pydot', 'multiprocessing', 'subprocess') if m in sys.modules)))",
+        ], cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+        self.assertEqual(output.strip(), "")
+
+
+class TestStronglyConnectedComponents(unittest.TestCase):
+    def testReverseTopologicalOrder(self):
+        succs = {"a": set(["b"]), "b": set(["c", "d"]), "c": set(["b"]), "d": set()}
+        components = strongly_connected_components(["a", "b", "c", "d"], succs)
+        self.assertEqual([sorted(c) for c in components], [["d"], ["b", "c"], ["a"]])
+
+    def testLongChain(self):
+        # Much deeper than the recursion limit.
+        n = 5000
+        succs = dict((i, set([i + 1])) for i in range(n))
+        components = strongly_connected_components(range(n + 1), succs)
+        self.assertEqual(components, [[i] for i in range(n, -1, -1)])
+
+
+class TestAnalyzeGraphInfo(unittest.TestCase):
+    def testClean(self):
+        graph_info = parse_schedulers([
+            Scheduler("base", ("build",)),
+            Dependent("test", ("test",), upstream_name="base"),
+            AggregatingScheduler("agg", ("agg",), upstreamBuilders=("build", "test")),
+        ])
+        report = analyze_graph_info(graph_info)
+        self.assertEqual(report["cycles"], [])
+        self.assertEqual(report["unreachable_builders"], [])
+        self.assertEqual(report["orphaned_schedulers"], [])
+        self.assertEqual(report["longest_chains"], {
+            "base scheduler": ["base scheduler", "build", "test scheduler", "test", "agg scheduler", "agg"],
+        })
+        order = report["order"]
+        for left, right in combine_graph_info([graph_info])["base scheduler"]["edges"]:
+            self.assertLess(order.index(left), order.index(right))
+
+    def testProblems(self):
+        graph_info = parse_schedulers([
+            Scheduler("base", ("build",)),
+            # These two trigger each other, but nothing leads to them.
+            Triggerable("ping", ("ping",)),
+            Triggerable("pong", ("pong",)),
+            # This one is triggered by the end of a cycle that a root leads to.
+            Dependent("loop", ("build",), upstream_name="base"),
+        ], triggerables={"ping": ["pong"], "pong": ["ping"]})
+        report = analyze_graph_info(graph_info)
+        self.assertEqual(report["cycles"], [
+            ["build", "loop scheduler"],
+            ["ping", "ping scheduler", "pong", "pong scheduler"],
+        ])
+        self.assertEqual(report["orphaned_schedulers"], ["ping scheduler", "pong scheduler"])
+        self.assertEqual(report["unreachable_builders"], ["ping", "pong"])
+        self.assertEqual(report["longest_chains"]["base scheduler"], ["base scheduler", "build"])
+
+    def testChainThroughCycle(self):
+        graph_info = {
+            "r": {
+                "nodes": set(("r", "a", "b", "c", "d", "e")),
+                "edges": set((("r", "a"), ("a", "b"), ("b", "c"), ("c", "a"), ("c", "d"), ("d", "e"))),
+                "root": True,
+            },
+        }
+        report = analyze_graph_info(graph_info)
+        self.assertEqual(report["cycles"], [["a", "b", "c"]])
+        chain = report["longest_chains"]["r"]
+        self.assertEqual(chain, ["r", "a", "b", "c", "d", "e"])
+        for left, right in zip(chain, chain[1:]):
+            self.assertIn((left, right), graph_info["r"]["edges"])
+
+    def testReportWrittenIntoOutputDir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot = os.path.join(tmpdir, "snapshot.json")
+        write_snapshot(snapshot, [("master", [{"name": "foo", "builderNames": ["bar"]}])])
+        output_dir = os.path.join(tmpdir, "out")
+        os.mkdir(output_dir)
+        with mock.patch("sys.argv", ["buildbot-scheduler-graph", snapshot, output_dir, "--from-snapshot", "--analyze"]):
+            buildbot_scheduler_graph.main()
+        with open(os.path.join(output_dir, "analysis.json")) as f:
+            self.assertEqual([m["name"] for m in json.load(f)["masters"]], ["master"])
+
+        # A file where the output directory should be is an error.
+        with mock.patch("sys.argv", ["buildbot-scheduler-graph", snapshot, snapshot, "--from-snapshot", "--analyze"]), \
+                mock.patch("sys.stderr", StringIO()) as stderr:
+            self.assertRaises(SystemExit, buildbot_scheduler_graph.main)
+        self.assertIn("isn't a directory", stderr.getvalue())
+
+
+class TestReadMapping(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "mapping")
+
+    def writeMapping(self, contents):
+        with open(self.filename, "w") as f:
+            f.write(contents)
+
+    def testJson(self):
+        self.writeMapping(json.dumps({"foo": ["a", "b"], "bar": ["c"]}, indent=2))
+        self.assertEqual(read_mapping(self.filename), {"foo": ["a", "b"], "bar": ["c"]})
+
+    def testJsonLines(self):
+        self.writeMapping('{"foo": ["a", "b"]}\n{"bar": ["c"]}\n\n{"foo": ["b", "d"], "bar": ["c"]}\n')
+        self.assertEqual(read_mapping(self.filename), {"foo": ["a", "b", "d"], "bar": ["c"]})
+
+    def testBadLine(self):
+        self.writeMapping('{"foo": ["a"]}\n["bar"]\n')
+        self.assertRaises(ValueError, read_mapping, self.filename)